@@ -3,26 +3,51 @@
 import wx
 import wx.html2
 #import wx.html
-import wx.lib.mixins.listctrl
 
 import os
 import random
 import signal
+import threading
+import time
 
 import hashlib
 import pathlib
 
 from database import Database
+from database import MessageListCache
+from database import MessageViewCache
+from database import listColumns
 from Parser import parseEmailFolder
 
-class MyFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
+class MessageListCtrl(wx.ListCtrl):
+    # Virtual list, the rows are only read from the database when displayed
+    def __init__(self, parent, id, rows, style):
+        wx.ListCtrl.__init__(self, parent, id, style = style | wx.LC_VIRTUAL)
+        self.rows = rows
+
+    def OnGetItemText(self, item, column):
+        row = self.rows.getRow(item)
+        return '' if row is None else str(row[column])
+
+class MyFrame(wx.Frame):
     def __init__(self, *args, **kwds):
         wx.Frame.__init__(self, *args, **kwds)
 
         # Open the database in memory by default
         self.database = Database("database.db")
         self.current_path = ""
-        self.itemDataMap = {}
+        self.message_rows = MessageListCache(self.database)
+        self.message_views = MessageViewCache(self.database)
+        self.prefetch_timer = None
+        self.prefetch_neighbours = 8
+        self.current_message = None
+        self.sort_column = listColumns.index('date')
+        self.sort_descending = True
+        self.categories = []
+        self.category_items = {}
+        self.import_thread = None
+        self.import_cancel = threading.Event()
+        self.import_refreshed = 0
   
         # Menu
         #  ----------------------------------------
@@ -32,9 +57,11 @@ class MyFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
         menu_it_file = wx.Menu()
         menu_it_file_save_db = menu_it_file.Append(wx.ID_ANY, "&Save database as ...")
         menu_it_file_load_db = menu_it_file.Append(wx.ID_ANY, "&Load database")
+        menu_it_file_export_attachments = menu_it_file.Append(wx.ID_ANY, "&Export attachments of the listed messages ...")
         menu_bar.Append(menu_it_file, "&File")
         self.Bind(wx.EVT_MENU, self.OnSaveDatabase, menu_it_file_save_db)
         self.Bind(wx.EVT_MENU, self.OnLoadDatabase, menu_it_file_load_db)
+        self.Bind(wx.EVT_MENU, self.OnExportAttachments, menu_it_file_export_attachments)
 
         # Import menu item
         menu_it_import      = wx.Menu()
@@ -86,12 +113,14 @@ class MyFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
         self.Bind(wx.EVT_TREE_SEL_CHANGED, self.onCategorySelected, self.tree_categories)
 
         # Messages list
-        self.ctrl_messages_list = wx.ListCtrl(
-             self.layout_msg_list_pane, wx.ID_ANY, style=wx.LC_HRULES | wx.LC_REPORT | wx.LC_VRULES)
+        self.ctrl_messages_list = MessageListCtrl(
+             self.layout_msg_list_pane, wx.ID_ANY, self.message_rows, style=wx.LC_HRULES | wx.LC_REPORT | wx.LC_VRULES)
         self.Bind(wx.EVT_LIST_ITEM_SELECTED, self.onMessageSelected, self.ctrl_messages_list)
+        self.Bind(wx.EVT_LIST_COL_CLICK, self.onColumnClick, self.ctrl_messages_list)
 
         # Message body
         self.ctrl_message_view = wx.Notebook(self.layout_msg_body_pane, wx.ID_ANY, style=wx.NB_BOTTOM)
+        self.Bind(wx.EVT_NOTEBOOK_PAGE_CHANGED, self.onMessageViewChanged, self.ctrl_message_view)
         self.ctrl_message_view_html = wx.Panel(self.ctrl_message_view, wx.ID_ANY)
         self.ctrl_message_view_plain = wx.Panel(self.ctrl_message_view, wx.ID_ANY)
         self.ctrl_message_view_code = wx.Panel(self.ctrl_message_view, wx.ID_ANY)
@@ -105,6 +134,13 @@ class MyFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
         self.btn_download = wx.Button(self.layout_right_pane, wx.ID_ANY, "Download")
         self.Bind(wx.EVT_BUTTON, self.onAttachmentDownload, self.btn_download)
 
+        # Import progress panel, only shown while importing
+        self.layout_import_pane = wx.Panel(self.layout_right_pane, wx.ID_ANY)
+        self.gauge_import = wx.Gauge(self.layout_import_pane, wx.ID_ANY, 1000)
+        self.txt_import = wx.StaticText(self.layout_import_pane, wx.ID_ANY, "")
+        self.btn_import_cancel = wx.Button(self.layout_import_pane, wx.ID_ANY, "Cancel")
+        self.Bind(wx.EVT_BUTTON, self.onImportCancel, self.btn_import_cancel)
+
         # Filters
         self.txt_filter_receivers = wx.TextCtrl(self.layout_left_pane, wx.ID_ANY, "")
         self.txt_filter_sender = wx.TextCtrl(self.layout_left_pane, wx.ID_ANY, "")
@@ -120,24 +156,107 @@ class MyFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
 
         self.Layout()
         self.OnDatabseUpdate()
+        self._index_search()
+
+    def _index_search(self):
+        # Databases of older versions, or written by other programs, miss
+        # messages in the search index. It is completed on its own thread and
+        # connection, searches use LIKE filters until then.
+        if not self.database.hasSearch or self.database.searchReady:
+            return
+
+        def index(filename):
+            try:
+                indexed = Database(filename).rebuildSearchIndex()
+                print("Indexed %d messages for the search" % indexed)
+            except Exception as e:
+                print("Could not index the messages: " + str(e))
+
+            wx.CallAfter(self.onSearchIndexed, filename)
+
+        threading.Thread(target=index, args=(self.database.filename,), daemon=True).start()
+
+    def onSearchIndexed(self, filename):
+        if self.database.filename == filename:
+            self.database.checkSearchIndex()
 
     def OnExportEml(self, e):
         print("OnExportEml")
         self.Close()
 
     def _import_folder_dialog(self, fileType):
+        if self.import_thread is not None and self.import_thread.is_alive():
+            print("An import is already running")
+            return
+
         dirname = ""
         dlg = wx.DirDialog(self, message="Choose emails folder")
  
         if dlg.ShowModal() == wx.ID_OK:
             dirname = dlg.GetPath()
-            parseEmailFolder(self.database, dirname, fileType)
-            print("Done parsing: " + str(dirname))
 
-            self.OnDatabseUpdate()
+            self.import_cancel.clear()
+            self.import_thread = threading.Thread(
+                target=self._import_folder, args=(self.database.filename, dirname, fileType), daemon=True)
+            self.import_thread.start()
+
+            self.txt_import.SetLabel("Importing " + str(dirname))
+            self.gauge_import.SetValue(0)
+            self.layout_import_pane.Show()
+            self.layout_right_pane.Layout()
 
         dlg.Destroy()
 
+    def _import_folder(self, filename, dirname, fileType):
+        # Runs on the import thread, with its own connection to the database
+        # file as sqlite connections can't be shared between threads.
+        progress = None
+
+        try:
+            database = Database(filename)
+            progress = parseEmailFolder(database, dirname, fileType,
+                                        workers = os.cpu_count() or 1,
+                                        startMethod = 'spawn',
+                                        onProgress = lambda progress: wx.CallAfter(self.onImportProgress, progress),
+                                        cancel = self.import_cancel)
+            del database
+        except Exception as e:
+            print("Could not import the folder: " + str(e))
+
+        wx.CallAfter(self.onImportDone, dirname, progress)
+
+    def onImportProgress(self, progress):
+        if progress.bytesTotal > 0:
+            self.gauge_import.SetValue(int(1000 * progress.bytesProcessed / progress.bytesTotal))
+        self.txt_import.SetLabel(str(progress))
+
+        # Show what was committed so far, without refreshing on every batch
+        if time.monotonic() - self.import_refreshed > 2:
+            self.import_refreshed = time.monotonic()
+
+            # Conversations get regrouped during the import
+            self.message_views.reset(self.database)
+
+            categories = self.database.getCategoryCounts()
+            if categories != self.categories:
+                self.onCategoriesUpdate(categories)
+
+            self.onMessageListUpdate(self.getFilters(), False)
+
+    def onImportDone(self, dirname, progress):
+        if progress is not None:
+            print(("Cancelled parsing: " if progress.cancelled else "Done parsing: ") + str(dirname))
+            print(progress)
+
+        self.layout_import_pane.Hide()
+        self.layout_right_pane.Layout()
+
+        self.OnDatabseUpdate()
+
+    def onImportCancel(self, event):
+        self.import_cancel.set()
+        self.txt_import.SetLabel("Cancelling ...")
+
     def OnImportEml(self, e):
         print("OnImportEml")
 
@@ -160,6 +279,7 @@ class MyFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
                 self.database = Database(str(file))
 
                 self.OnDatabseUpdate()
+                self._index_search()
 
             dlg.Destroy()
         except Exception as e:
@@ -190,9 +310,6 @@ class MyFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
         self.ctrl_messages_list.AppendColumn("Date", format=wx.LIST_FORMAT_LEFT, width=200)
         self.ctrl_messages_list.AppendColumn("Attachments", format=wx.LIST_FORMAT_LEFT, width=500)
 
-        # initialize the column sorter
-        wx.lib.mixins.listctrl.ColumnSorterMixin.__init__(self, 6)
-
         if "gtk2" in wx.PlatformInfo: 
             self.ctrl_message_content.SetStandardFonts() 
 
@@ -232,11 +349,20 @@ class MyFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
         attachmentPane.Add(self.combo_attachments, 1, 0, 0)
         attachmentPane.Add(self.btn_download, 1, 0, 0)
 
+        # Import progress pane
+        importPane = wx.BoxSizer(wx.HORIZONTAL)
+        importPane.Add(self.gauge_import, 1, wx.EXPAND, 0)
+        importPane.Add(self.txt_import, 2, wx.ALIGN_CENTER_VERTICAL | wx.LEFT, 5)
+        importPane.Add(self.btn_import_cancel, 0, 0, 0)
+        self.layout_import_pane.SetSizer(importPane)
+        self.layout_import_pane.Hide()
+
         # Content Layout
         self.layout_content.SetSashGravity(0.2)
         self.layout_content.SplitHorizontally(self.layout_msg_list_pane, self.layout_msg_body_pane)
         rightPane.Add(self.layout_content, 1, wx.EXPAND, 0)
         rightPane.Add(attachmentPane, 0, wx.EXPAND, 0)
+        rightPane.Add(self.layout_import_pane, 0, wx.EXPAND, 0)
         self.layout_right_pane.SetSizer(rightPane)
 
         # Category Pane
@@ -285,14 +411,16 @@ class MyFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
         self.SetSizer(sizer)
  
     def onMessageSelected(self, event):
-        hash = self.ctrl_messages_list.GetItem(event.GetIndex(), 0).GetText()
-        html, plain = self.database.getContent(hash)
+        index = event.GetIndex()
+        hash = self.message_rows.getRow(index)[0]
+        html, plain, attachments = self.message_views.get(hash)
+        self.current_message = hash
 
         # Load the selected page
         try:
             self.ctrl_message_content.SetPage(html, "")
             self.ctrl_message_content_plain.SetValue(plain)
-            self.ctrl_message_content_code.SetValue(html)
+            self.ctrl_message_content_code.SetValue("")
 
             if html.strip() == "":
                 if (self.ctrl_message_view.GetSelection() == 0):
@@ -300,16 +428,51 @@ class MyFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
             elif (self.ctrl_message_view.GetSelection() != 0):
                 self.ctrl_message_view.SetSelection(0)
 
+            self.showMessageSource()
+
         except:
             self.ctrl_message_content.SetPage("Problem while loading content", "")
             self.ctrl_message_content_plain.SetValue("Problem while loading content")
             self.ctrl_message_content_code.SetValue("Problem while loading content")
 
-        attachments = self.database.getAttachementNames(hash)
         self.setAttachments(attachments)
 
+        # Read the next messages once the user stops for a moment
+        if self.prefetch_timer is not None:
+            self.prefetch_timer.Stop()
+        self.prefetch_timer = wx.CallLater(50, self.prefetchMessages, index)
+
+        event.Skip()
+
+    def onMessageViewChanged(self, event):
+        self.showMessageSource()
         event.Skip()
 
+    def showMessageSource(self):
+        # The source is read from the archive, only when the Code tab is shown
+        if self.ctrl_message_view.GetSelection() != 2 or self.current_message is None:
+            return
+        if self.ctrl_message_content_code.GetValue():
+            return
+
+        source = self.database.getRawMessage(self.current_message)
+        if source is None:
+            # Not imported with its source, or the archive was moved
+            source = self.message_views.get(self.current_message)[0]
+        else:
+            source = source.decode('utf-8', 'replace')
+
+        self.ctrl_message_content_code.SetValue(source)
+
+    def prefetchMessages(self, index):
+        self.prefetch_timer = None
+
+        count = self.ctrl_messages_list.GetItemCount()
+        neighbours = range(max(index - self.prefetch_neighbours, 0), min(index + self.prefetch_neighbours + 1, count))
+
+        rows = [self.message_rows.getRow(item) for item in neighbours]
+        self.message_views.prefetch(row[0] for row in rows if row is not None)
+
     def setAttachments(self, entries):
         self.combo_attachments.Clear()
 
@@ -331,18 +494,10 @@ class MyFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
         return randomStringlist
 
     def onCategorySelected(self, event):
-        previous = ""
-        cale = ""
-        curent = event.GetItem()
-        while (curent.IsOk()):
-           # Don't include the root node
-           cale = previous + cale
- 
-           previous = "/" + str(self.tree_categories.GetItemText(curent))
-           curent = self.tree_categories.GetItemParent(curent)
-
-        self.current_path = cale
-        print(cale)
+        # The items carry their path, the labels also show the counts
+        item = event.GetItem()
+        self.current_path = (self.tree_categories.GetItemData(item) if item.IsOk() else None) or ""
+        print(self.current_path)
 
         self.OnDatabseUpdate(True)
 
@@ -356,22 +511,30 @@ class MyFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
             event.Skip()
             return
 
-        hash = self.ctrl_messages_list.GetItem(index, 0).GetText()
+        hash = self.message_rows.getRow(index)[0]
         file = self.combo_attachments.GetStringSelection()
 
-        if (hash != "" and file != ""):
+        if (hash is not None and file != ""):
             try:
-                dlg = wx.FileDialog(self, "Save to file:", ".", file, "Sqlite databse (*.db)|*.db", wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
+                dlg = wx.FileDialog(self, "Save to file:", ".", file, "All files (*.*)|*.*", wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
                 if (dlg.ShowModal() == wx.ID_OK):
                     filename = dlg.GetFilename()
                     dirname = dlg.GetDirectory()
                     filePath = str(os.path.join(dirname, filename))
-                    data = self.database.getAttachmentData(hash, file)
 
-                    if data is not None:
-                       with open(filePath, 'wb') as fp:
-                           fp.write(data)
-                    # else error message? Normally, should not occur.
+                    # Copied in chunks, the progress dialog keeps the UI responsive
+                    progress = wx.ProgressDialog("Saving attachment", file, 1000, self,
+                                                 wx.PD_APP_MODAL | wx.PD_CAN_ABORT | wx.PD_AUTO_HIDE)
+                    with open(filePath, 'wb') as fp:
+                        copied = self.database.copyAttachment(hash, file, fp,
+                            onProgress = lambda copied, total: progress.Update(int(1000 * copied / max(total, 1)))[0])
+                    progress.Destroy()
+
+                    # Aborted, the partial file is of no use
+                    if copied != self.database.getAttachmentSize(hash, file):
+                        os.remove(filePath)
+                        wx.MessageBox("Saving was cancelled, " + filePath + " was not written.",
+                                      "Saving attachment", wx.OK | wx.ICON_INFORMATION, self)
 
                 dlg.Destroy()
             except Exception as e:
@@ -380,6 +543,33 @@ class MyFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
 
         event.Skip()
 
+    def OnExportAttachments(self, e):
+        print("OnExportAttachments")
+
+        dlg = wx.DirDialog(self, "Export the attachments to", ".", wx.DD_DEFAULT_STYLE)
+        if (dlg.ShowModal() == wx.ID_OK):
+            progress = wx.ProgressDialog("Exporting attachments", "", 1000, self,
+                                         wx.PD_APP_MODAL | wx.PD_CAN_ABORT | wx.PD_AUTO_HIDE)
+            state = {'running' : True}
+            files = []
+
+            def onProgress(path, copied, total):
+                state['running'] = progress.Update(int(1000 * copied / max(total, 1)), path)[0]
+                return state['running']
+
+            try:
+                files = self.database.exportAttachments(dlg.GetPath(), onProgress = onProgress, **self.getFilters())
+                print("Exported %d attachments" % len(files))
+            except Exception as e:
+                print("Could not export the attachments: " + str(e))
+            progress.Destroy()
+
+            if not state['running']:
+                wx.MessageBox("The export was cancelled, %d attachments were exported." % len(files),
+                              "Exporting attachments", wx.OK | wx.ICON_INFORMATION, self)
+
+        dlg.Destroy()
+
     def onFilterActivated(self, event):
         self.OnDatabseUpdate()
 
@@ -390,53 +580,96 @@ class MyFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
         self.txt_filter_content.SetValue("")
         self.OnDatabseUpdate()
 
-    def addCategories(self, root, categories):
+    def addCategories(self, root, path, categories):
         for category in categories:
-            item = self.tree_categories.AppendItem(root, category)
-            self.addCategories(item, categories[category])
+            item = self.tree_categories.AppendItem(root, category, data = path + '/' + category)
+            self.category_items[path + '/' + category] = item
+            self.addCategories(item, path + '/' + category, categories[category])
 
     def onCategoriesUpdate(self, categories):
+        # The categories come with their counts, (category, messages, unread,
+        # attachments), a node shows the counts of its whole branch.
+        self.categories = categories
         categoriesOverview = {}
-        for category in categories:
+        totals = {"": [0, 0, 0]}
+        for category, messages, unread, attachments in categories:
             subPaths = category.split('/')
             currentEntry = categoriesOverview
+            paths = [""]
             for subPath in subPaths:
                 if subPath == "":
                     continue
                 if subPath not in currentEntry:
                     currentEntry[subPath] = {}
                 currentEntry = currentEntry[subPath]
+                paths.append(paths[-1] + '/' + subPath)
+
+            for path in paths:
+                total = totals.setdefault(path, [0, 0, 0])
+                total[0] += messages
+                total[1] += unread
+                total[2] += attachments
+
+        # Only rebuild the tree when folders come or go, otherwise the labels
+        # are updated in place and the selection is kept.
+        if set(totals) != set(self.category_items):
+            self.tree_categories.DeleteAllItems()
+            root = self.tree_categories.AddRoot('/', data = "")
+            self.category_items = {"": root}
+            self.addCategories(root, "", categoriesOverview)
+            self.tree_categories.ExpandAll()
+
+        for path, item in self.category_items.items():
+            messages, unread, attachments = totals[path]
+            label = path.split('/')[-1] or '/'
+            if unread > 0:
+                label += ' (%d, %d unread)' % (messages, unread)
+            else:
+                label += ' (%d)' % messages
+
+            self.tree_categories.SetItemText(item, label)
+            self.tree_categories.SetItemBold(item, unread > 0)
+
+    def onColumnClick(self, event):
+        column = event.GetColumn()
+
+        # Sorting is done by the database, clicking again reverses it
+        if column == self.sort_column:
+            self.sort_descending = not self.sort_descending
+        else:
+            self.sort_column = column
+            self.sort_descending = False
 
-        self.tree_categories.DeleteAllItems()
-        root = self.tree_categories.AddRoot('/')
-        self.addCategories(root, categoriesOverview)
-        self.tree_categories.ExpandAll()
+        self.OnDatabseUpdate(True)
+
+    def onMessageListUpdate(self, filters, clearSelection = True):
+        count = self.message_rows.reset(self.database, filters,
+                                        listColumns[self.sort_column], self.sort_descending)
 
-    def onMessageListUpdate(self, messages):
-        self.ctrl_messages_list.DeleteAllItems()
-        self.itemDataMap.clear()
+        if clearSelection:
+            # Item -1 stands for all the items of a virtual list
+            self.ctrl_messages_list.SetItemState(-1, 0, wx.LIST_STATE_SELECTED)
+        self.ctrl_messages_list.SetItemCount(count)
+        self.ctrl_messages_list.Refresh()
 
-        for item in messages:
-            dataTuple = [item[0], item[1], item[2], item[3], item[4], item[5]]
-            index = self.ctrl_messages_list.Append(dataTuple)
+        if hasattr(self.ctrl_messages_list, 'ShowSortIndicator'):
+            self.ctrl_messages_list.ShowSortIndicator(self.sort_column, not self.sort_descending)
 
-            self.ctrl_messages_list.SetItemData(index, index)
-            self.itemDataMap[index] = item
+    def getFilters(self):
+        return {
+            'category'   : self.current_path,
+            'recipients' : self.txt_filter_receivers.GetValue(),
+            'sender'     : self.txt_filter_sender.GetValue(),
+            'subject'    : self.txt_filter_subject.GetValue(),
+            'content'    : self.txt_filter_content.GetValue()}
 
     def OnDatabseUpdate(self, skipCategories = False):
         if not skipCategories:
+           self.message_views.reset(self.database)
+
            # We won't filter categories, although we could
-           self.onCategoriesUpdate(self.database.getCategories())
-        self.onMessageListUpdate(
-           self.database.getMessages(
-               category = self.current_path,
-               recipients = self.txt_filter_receivers.GetValue(),
-               sender = self.txt_filter_sender.GetValue(),
-               subject = self.txt_filter_subject.GetValue(),
-               content = self.txt_filter_content.GetValue()))
-
-    def GetListCtrl(self):
-        return self.ctrl_messages_list
+           self.onCategoriesUpdate(self.database.getCategoryCounts())
+        self.onMessageListUpdate(self.getFilters())
 
 class MyApp(wx.App):
 
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+
+# Command line entry point for imports, searches and attachment exports on
+# machines without a display. Only Parser and Database are loaded, not wx.
+
+import argparse
+import itertools
+import json
+import os
+import signal
+import sys
+import threading
+
+import database
+
+from database import Database
+from database import listColumns
+from commons import parseDate
+from Parser import parseEmailFolder
+from Parser import migrateMessageIds
+
+def importFolder(options):
+    db = Database(options.database)
+
+    # Ctrl+C stops the import after the current entry, keeping what is committed
+    cancel = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: cancel.set())
+
+    def onProgress(progress):
+        if not options.quiet:
+            sys.stderr.write('\r' + str(progress))
+            sys.stderr.flush()
+
+    for entryType in options.type:
+        progress = parseEmailFolder(db, options.folder, entryType, options.batch_size, options.workers,
+                                    deferIndexes = options.defer_indexes, onProgress = onProgress, cancel = cancel,
+                                    instrument = options.instrument, profile = options.profile,
+                                    profileFile = options.profile_file)
+        if not options.quiet:
+            sys.stderr.write('\n')
+
+        if progress.report is not None:
+            sys.stderr.write(progress.report + '\n')
+
+        if progress.cancelled:
+            return 1
+
+    return 0
+
+def getDateRange(options):
+    # The --since and --until dates, already UTC timestamps
+    return {name : getattr(options, name) for name in ['since', 'until'] if getattr(options, name) is not None}
+
+def timestamp(text):
+    value = parseDate(text)[1]
+    if value is None:
+        raise argparse.ArgumentTypeError('unreadable date: ' + text)
+    return value
+
+def searchMessages(options):
+    db = Database(options.database)
+
+    if db.hasSearch and not db.searchReady:
+        print('The search index is incomplete, searching without it until "maintain %s rebuild-index" is run'
+              % options.database, file = sys.stderr)
+    filters = {name : getattr(options, name) or '' for name in ['category', 'recipients', 'sender', 'subject', 'content']}
+    filters.update(getDateRange(options))
+
+    rows = db.getMessages(ranked = options.ranked, **filters)
+    if options.limit is not None:
+        rows = itertools.islice(rows, options.limit)
+
+    # One JSON object per line, written as the rows are read
+    for row in rows:
+        message = dict(zip(listColumns, row))
+
+        if options.body:
+            message['html'], message['plain'] = db.getContent(message['message_id'])
+            message['attachments'] = db.getAttachementNames(message['message_id'])
+
+        sys.stdout.write(json.dumps(message) + '\n')
+
+    return 0
+
+def listCorrespondents(options):
+    db = Database(options.database)
+
+    for address, messages in db.getCorrespondents(options.role, options.limit):
+        sys.stdout.write(json.dumps({'address' : address, 'messages' : messages}) + '\n')
+
+    return 0
+
+def exportAttachments(options):
+    db = Database(options.database)
+    names = options.name or db.getAttachementNames(options.message_id)
+
+    if options.list:
+        for name in names:
+            print(name)
+        return 0
+
+    os.makedirs(options.output, exist_ok = True)
+
+    for name in names:
+        # The names come from the messages, they must not leave the folder
+        fileName = os.path.join(options.output, os.path.basename(name))
+        with open(fileName, 'wb') as file:
+            copied = db.copyAttachment(options.message_id, name, file)
+
+        if copied is None:
+            os.remove(fileName)
+            print('No attachment %s in message %d' % (name, options.message_id), file = sys.stderr)
+            return 1
+
+        print(fileName)
+
+    return 0
+
+def exportAllAttachments(options):
+    db = Database(options.database)
+    filters = {name : getattr(options, name) or '' for name in ['category', 'recipients', 'sender', 'subject', 'content']}
+
+    for fileName in db.exportAttachments(options.output, **filters):
+        print(fileName)
+
+    return 0
+
+def migrateIds(options):
+    migrateMessageIds(Database(options.database), options.folder, options.batch_size)
+    return 0
+
+def maintainDatabase(options):
+    database.commands[options.command](Database(options.database), *options.arguments)
+    return 0
+
+def getArguments():
+    arguments = argparse.ArgumentParser(description = 'Import, search and export email archives without the GUI')
+    commands  = arguments.add_subparsers(dest = 'action', required = True)
+
+    command = commands.add_parser('import', help = 'import the eml or mbox files of a folder')
+    command.add_argument('database')
+    command.add_argument('folder')
+    command.add_argument('--type', choices = ['eml', 'mbox'], action = 'append', required = True,
+                         help = 'file type to import, can be repeated')
+    command.add_argument('--workers', type = int, default = os.cpu_count() or 1, help = 'parsing processes')
+    command.add_argument('--batch-size', type = int, default = 1000, help = 'entries per transaction')
+    command.add_argument('--defer-indexes', action = 'store_true', help = 'rebuild the indexes once at the end')
+    command.add_argument('--instrument', action = 'store_true', help = 'print the time spent per stage')
+    command.add_argument('--profile', choices = ['cprofile', 'tracemalloc'])
+    command.add_argument('--profile-file', help = 'where the profile is written')
+    command.add_argument('--quiet', action = 'store_true', help = 'no progress output')
+    command.set_defaults(function = importFolder)
+
+    command = commands.add_parser('search', help = 'print the matching messages as JSON lines')
+    command.add_argument('database')
+    for name in ['category', 'recipients', 'sender', 'subject', 'content']:
+        command.add_argument('--' + name)
+    command.add_argument('--since', type = timestamp, help = 'first date included, e.g. 2020-01-01')
+    command.add_argument('--until', type = timestamp, help = 'first date excluded')
+    command.add_argument('--ranked', action = 'store_true', help = 'best content matches first')
+    command.add_argument('--limit', type = int)
+    command.add_argument('--body', action = 'store_true', help = 'include the bodies and attachment names')
+    command.set_defaults(function = searchMessages)
+
+    command = commands.add_parser('correspondents', help = 'print the addresses by number of messages as JSON lines')
+    command.add_argument('database')
+    command.add_argument('--role', choices = ['from', 'to', 'cc'])
+    command.add_argument('--limit', type = int)
+    command.set_defaults(function = listCorrespondents)
+
+    command = commands.add_parser('attachments', help = 'list or extract the attachments of a message')
+    command.add_argument('database')
+    command.add_argument('message_id', type = int)
+    command.add_argument('--name', action = 'append', help = 'attachment to extract, all of them by default')
+    command.add_argument('--output', default = '.', help = 'folder the attachments are written to')
+    command.add_argument('--list', action = 'store_true', help = 'only print the names')
+    command.set_defaults(function = exportAttachments)
+
+    command = commands.add_parser('export-attachments', help = 'extract the attachments of the matching messages')
+    command.add_argument('database')
+    command.add_argument('output', help = 'folder the attachments are written to, per message id')
+    for name in ['category', 'recipients', 'sender', 'subject', 'content']:
+        command.add_argument('--' + name)
+    command.set_defaults(function = exportAllAttachments)
+
+    command = commands.add_parser('migrate-ids', help = 'move a database to the Message-ID based ids')
+    command.add_argument('database')
+    command.add_argument('folder', help = 'folder the eml files were imported from')
+    command.add_argument('--batch-size', type = int, default = 1000)
+    command.set_defaults(function = migrateIds)
+
+    command = commands.add_parser('maintain', help = 'run a maintenance command of the database')
+    command.add_argument('database')
+    command.add_argument('command', choices = sorted(database.commands))
+    command.add_argument('arguments', nargs = '*')
+    command.set_defaults(function = maintainDatabase)
+
+    return arguments
+
+if __name__ == '__main__':
+    options = getArguments().parse_args()
+
+    try:
+        exit(options.function(options))
+    except BrokenPipeError:
+        # e.g. piped into head, the rest of the output isn't wanted
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        exit(0)
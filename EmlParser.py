@@ -2,108 +2,113 @@
 
 from email import policy
 from email.header import decode_header
-from email.parser import BytesParser
-from dateutil.parser import parse
+from email.parser import BytesFeedParser
 
+import hashlib
 import pathlib
 import json
 import sys
 
 from dataTypes import Attachment
 from dataTypes import Message
+from dataTypes import Content
+from dataTypes import MessageSource
 
 from commons import readFile
 from commons import extractEmails
+from commons import getAddressEntries
+from commons import getContentHash
 from commons import getHashOfItem
+from commons import getHashOfBytes
+from commons import getHashOfDigest
+from commons import extractParts
+from commons import parseDate
+
+from instrumentation import timed
 
 class EmlParser():
     def __init__(self, fileName):
-        self.message = BytesParser(policy=policy.default).parsebytes(readFile(fileName))
+        # The file is hashed while it is fed to the parser, which gives the
+        # fallback id without another pass over the message.
+        parser      = BytesFeedParser(policy=policy.default)
+        self.digest = hashlib.sha1()
+        self.size   = 0
+
+        with open(fileName, 'rb') as file:
+            while True:
+                with timed('read'):
+                    chunk = file.read(1 << 16)
+                if not chunk:
+                    break
+
+                with timed('mime.parse'):
+                    parser.feed(chunk)
+                with timed('hash'):
+                    self.digest.update(chunk)
+                self.size += len(chunk)
+
+        with timed('mime.parse'):
+            self.message = parser.close()
+        with timed('mime.extract'):
+            self._extract()
 
     def getId(self):
-        return getHashOfItem(self.message)
-
-    def getAttachmentData(self, name):
-        for part in self.message.walk():
-            if 'content-disposition' not in part:
-                continue
+        # The Message-ID header identifies the message wherever it is stored,
+        # only messages without one fall back on their raw bytes.
+        messageId = str(self.message['Message-ID'] or '').strip()
 
-            cdisp = part['content-disposition'].split(';')
-            cdisp = [x.strip() for x in cdisp]
+        with timed('hash'):
+            if messageId:
+                return getHashOfBytes(b'Message-ID:' + messageId.encode('utf-8', 'surrogateescape'))
 
-            if cdisp[0].lower() != 'attachment':
-                continue
-            parsed = {}
+            return getHashOfDigest(self.digest)
 
-            for kv in cdisp[1:]:
-               if kv.startswith('filename='):
-                   key, _, val = kv.partition('=')
+    def getContentHash(self):
+        # Hash of the whole file
+        return self.digest.hexdigest()
 
-                   if val.startswith('"'):
-                       val = val.strip('"')
-                   elif val.startswith("'"):
-                       val = val.strip("'")
+    def getLegacyId(self):
+        # Id used before getId, only needed to migrate older databases
+        return getHashOfItem(self.message)
 
-                   if (name == val):
-                       return part.get_payload(decode=True)
+    def getAttachmentData(self, name):
+        for attachmentName, data in self.attachments:
+            if attachmentName == name:
+                return data
 
         return None
 
     def getAttachmentNames(self):
-        found = []
-
-        for part in self.message.walk():
-            if 'content-disposition' not in part:
-                continue
-
-            cdisp = part['content-disposition'].split(';')
-            cdisp = [x.strip() for x in cdisp]
-
-            if cdisp[0].lower() != 'attachment':
-                continue
-            parsed = {}
-
-            for kv in cdisp[1:]:
-               if kv.startswith('filename='):
-                   key, _, val = kv.partition('=')
-
-                   if val.startswith('"'):
-                       val = val.strip('"')
-                   elif val.startswith("'"):
-                       val = val.strip("'")
-
-                   found.append(val)
+        return [name for name, data in self.attachments]
 
-        return found
+    def getAttachments(self):
+        return self.attachments
 
     def getPayloadHtml(self):
-        body = self.message.get_body('html')
-
-        if (body):
-           return self._decode_body(body.get_payload(decode=True))
-
-        return ''
+        return self.body_html
 
     def getPayloadPlain(self):
-        body = self.message.get_body('plain')
-
-        if (body):
-           return self._decode_body(body.get_payload(decode=True))
+        return self.body_plain
 
-        return ''
+    def _extract(self):
+        # The names are already decoded by the parser policy
+        self.body_html, self.body_plain, self.attachments = extractParts(self.message)
 
     def getSender(self):
-        return extractEmails(str(self.message['from']))
+        return extractEmails(self.message['from'])
 
     def getReceivers(self):
-        return extractEmails(str(self.message['to']))
+        return extractEmails(self.message['to'])
+
+    def getCc(self):
+        return extractEmails(self.message['cc'])
 
     def getSubject(self):
         return self._decode_entry(self.message['Subject'])
 
     def getDate(self):
-        dt = parse(self.message['Date'])
-        return str(dt.date()) + " " + str(dt.time())
+        with timed('date'):
+            return parseDate(self.message['Date'])
 
     def _decode_entry(self, entry):
         if entry is None:
@@ -121,46 +126,62 @@ class EmlParser():
 
         return entry
 
-    def _decode_body(self, entry):
-        try:
-            entry = entry.decode('utf-8')
-        except UnicodeDecodeError:
-            entry = entry.decode('latin-1')
-
-        return entry
-
 def parse_eml(fileName):
-    message  = EmlParser(fileName)
+    return parse_eml_message(EmlParser(fileName), fileName)
+
+def parse_eml_message(message, fileName):
     result   = []
     category = ''
 
+    unread   = False
+
     metaFile = fileName + '.meta'
     if pathlib.Path(metaFile).exists():
         meta = json.loads(readFile(metaFile))
         if 'Path' in meta:
             category = meta['Path']
+        # Zimbra flags, u standing for unread
+        unread = 'u' in str(meta.get('Flags', ''))
 
-    attachments = message.getAttachmentNames()
+    attachments = message.getAttachments()
 
     msg = Message()
     msg.message_id      = message.getId()
     msg.sender          = ','.join(message.getSender())
     msg.recipients      = ','.join(message.getReceivers())
     msg.subject         = message.getSubject()
-    msg.date            = message.getDate()
-    msg.content         = message.getPayloadPlain()
-    msg.rich_content    = message.getPayloadHtml()
+    msg.date, msg.timestamp = message.getDate()
     msg.has_attachments = len(attachments)
     msg.category        = category
+    msg.is_unread       = 1 if unread else 0
 
-    for attachmentName in attachments:
+    for attachmentName, data in attachments:
         attachment = Attachment()
         attachment.message_id    = msg.message_id
         attachment.attachment_id = attachmentName
-        attachment.data          = message.getAttachmentData(attachmentName)
+        attachment.data          = data
+        # Hashed here, so it is spread over the parsing processes
+        if attachment.data is not None:
+            with timed('hash'):
+                attachment.data_hash = getContentHash(attachment.data)
         result.append(attachment)
     result.append(msg)
 
+    content = Content()
+    content.message_id   = msg.message_id
+    content.content      = message.getPayloadPlain()
+    content.rich_content = message.getPayloadHtml()
+    result.append(content)
+
+    result.extend(getAddressEntries(msg.message_id, [
+        ('from', message.getSender()), ('to', message.getReceivers()), ('cc', message.getCc())]))
+
+    source = MessageSource()
+    source.message_id = msg.message_id
+    source.path       = fileName
+    source.length     = message.size
+    result.append(source)
+
     return result
 
 if __name__ == '__main__':
@@ -1,25 +1,35 @@
 #!/usr/bin/python3
 
-from mailbox import mbox
+from mailbox import mboxMessage
 from email.header import decode_header
-from dateutil.parser import parse
 
+import mmap
 import os
 import sys
+import time
 
 from dataTypes import Conversation
 from dataTypes import Attachment
 from dataTypes import Message
+from dataTypes import Content
+from dataTypes import MessageSource
 
 from commons import readFile
 from commons import extractEmails
+from commons import getAddressEntries
+from commons import getContentHash
+from commons import decodeBody
+from commons import extractParts
+from commons import parseDate
+
+from instrumentation import timed
+from instrumentation import record
 
 class MboxParser():
     def __init__(self, data):
         self.message    = data
-        self.body_html  = ""
-        self.body_plain = ""
-        self._update_payload(self.message)
+        with timed('mime.extract'):
+            self._extract()
 
     def getId(self):
         fromInfo = str(self.message.get_from())
@@ -44,28 +54,17 @@ class MboxParser():
         return False
 
     def getAttachmentData(self, name):
-        for part in self.message.get_payload():
-            if isinstance(part, str) or str(part.get_filename()) == 'None':
-                continue
-
-            foundName = self._decode_entry(part.get_filename())
-            if foundName != name:
-                continue
-
-            return part.get_payload(decode=True)
+        for attachmentName, data in self.attachments:
+            if attachmentName == name:
+                return data
 
         return None
 
     def getAttachmentNames(self):
-        found = []
-
-        for part in self.message.get_payload():
-            if isinstance(part, str) or str(part.get_filename()) == 'None':
-                continue
+        return [name for name, data in self.attachments]
 
-            found.append(self._decode_entry(part.get_filename()))
-
-        return found
+    def getAttachments(self):
+        return self.attachments
 
     def getPayloadHtml(self):
         return self.body_html
@@ -74,10 +73,13 @@ class MboxParser():
         return self.body_plain
 
     def getSender(self):
-        return extractEmails(str(self.message['from']))
+        return extractEmails(self.message['from'])
 
     def getReceivers(self):
-        return extractEmails(str(self.message['to']))
+        return extractEmails(self.message['to'])
+
+    def getCc(self):
+        return extractEmails(self.message['cc'])
 
     def getSubject(self):
         return self._decode_entry(self.message['Subject'])
@@ -87,16 +89,14 @@ class MboxParser():
         fromInfo = str(self.message.get_from())
         length = fromInfo.find(' ')
 
-        if length != -1:
-            dt = parse(fromInfo[length+1:])
-            return str(dt.date()) + ' ' + str(dt.time())
-        else:
-            print('TODO date')
-            dt = parse(self.message['Date'])
-            return str(dt.date()) + " " + str(dt.time())
+        with timed('date'):
+            date = parseDate(fromInfo[length+1:]) if length != -1 else ('', None)
+
+            # From lines without a readable date fall back to the header
+            if date[1] is None:
+                date = parseDate(self.message['Date'])
 
-    def _update_payload(self, message):
-        raise Exception('Not implemented')
+            return date
 
     def _decode_entry(self, entry):
         if entry is None:
@@ -109,7 +109,7 @@ class MboxParser():
                 else:
                     encoding = part[1]
                     if (encoding is None) or (encoding == "unknown-8bit"):
-                        result += self._decode_body(part[0])
+                        result += decodeBody(part[0])
                     else:
                         result += part[0].decode(encoding)
 
@@ -117,61 +117,50 @@ class MboxParser():
 
         return entry
 
-    def _decode_body(self, entry):
-        try:
-            entry = entry.decode('utf-8')
-        except UnicodeDecodeError:
-            entry = entry.decode('latin-1')
-
-        return entry
-
-    def _update_payload(self, message):
-        if message.is_multipart():
-            for part in message.get_payload():
-                self._update_payload(part)
-        else:
-            contentType = message.get_content_type()
-
-            if ('text/plain' in contentType) or ('text/html' in contentType):
-                body = self._decode_body(message.get_payload(decode=True))
-
-                if 'text/html' in contentType:
-                    self.body_html = body
-                else:
-                    self.body_plain = body
+    def _extract(self):
+        self.body_html, self.body_plain, self.attachments = extractParts(self.message, self._decode_entry)
 
 def _parse_message(message, category):
     result   = []
 
-    attachments = message.getAttachmentNames()
+    attachments = message.getAttachments()
 
     msg = Message()
     msg.message_id      = message.getId()
     msg.sender          = ','.join(message.getSender())
     msg.recipients      = ','.join(message.getReceivers())
     msg.subject         = message.getSubject()
-    msg.date            = message.getDate()
-    msg.content         = message.getPayloadPlain()
-    msg.rich_content    = message.getPayloadHtml()
+    msg.date, msg.timestamp = message.getDate()
     msg.has_attachments = len(attachments)
     msg.category        = category
+    msg.is_unread       = 1 if message.isLabelSet('Unread') else 0
 
-    for attachmentName in attachments:
+    for attachmentName, data in attachments:
         attachment = Attachment()
         attachment.message_id    = msg.message_id
         attachment.attachment_id = attachmentName
-        attachment.data          = message.getAttachmentData(attachmentName)
+        attachment.data          = data
+        # Hashed here, so it is spread over the parsing processes
+        if attachment.data is not None:
+            with timed('hash'):
+                attachment.data_hash = getContentHash(attachment.data)
         result.append(attachment)
 
     result.append(msg)
 
+    content = Content()
+    content.message_id   = msg.message_id
+    content.content      = message.getPayloadPlain()
+    content.rich_content = message.getPayloadHtml()
+    result.append(content)
+
     return result
 
 def _parse_conversation(message):
     conversation = Conversation()
     conversation.conversation_id = message.getId()
     conversation.thread_id       = message.getThreadId()
-    conversation.date            = message.getDate()
+    conversation.date, conversation.timestamp = message.getDate()
 
     participants    = message.getSender()
     participants.extend(message.getReceivers())
@@ -207,20 +196,110 @@ def _parse_conversation(message):
 
     return conversation
 
-def parse_mbox(fileName):
-    result   = []
-
-    messages = mbox(fileName)
+def read_mbox(fileName, start = 0, end = None):
+    # Yields (offset, length, message) for the messages starting between the
+    # start and end offsets, which must be at the beginning of a "From " line.
+    # The messages are split like mailbox.mbox does, but in a single
+    # sequential pass, which also allows reading only the tail of a file.
+    with open(fileName, 'rb') as file:
+        file.seek(start)
+
+        position  = start
+        fromLine  = None
+        offset    = start
+        lines     = []
+        lastEmpty = False
+        # Time spent splitting the file, without the time of the consumer
+        resumed   = time.perf_counter()
+
+        while True:
+            line = file.readline() if (end is None or position < end) else b''
+
+            if line.startswith(b'From ') or not line:
+                if fromLine is not None:
+                    # The blank line before the next "From " line is a separator
+                    if lastEmpty:
+                        lines.pop()
+
+                    data = b''.join(lines)
+                    record('mbox.scan', time.perf_counter() - resumed)
+
+                    with timed('mime.parse'):
+                        message = mboxMessage(data)
+                    message.set_from(fromLine[5:].rstrip(b'\r\n').decode('ascii', 'replace'))
+                    yield (offset, position - offset, message)
+
+                    resumed = time.perf_counter()
+
+                if not line:
+                    break
+
+                fromLine = line
+                offset   = position
+                lines    = []
+            else:
+                lines.append(line)
+
+            lastEmpty = line in (b'\n', b'\r\n')
+            position += len(line)
+
+def split_mbox(fileName, start = 0, end = None, rangeSize = 16 << 20):
+    # Splits the file in (start, end) byte ranges of about rangeSize bytes,
+    # each starting at a message boundary, so they can be parsed separately
+    # with read_mbox. The start offset must be a boundary itself.
+    ranges = []
+
+    with open(fileName, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        end  = size if end is None else min(end, size)
+        if start >= end:
+            return ranges
+
+        with mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ) as data:
+            while start < end:
+                # The first boundary past the target size ends the range
+                position = data.find(b'\nFrom ', start + rangeSize - 1, end)
+                if start + rangeSize >= end or position == -1:
+                    ranges.append((start, end))
+                    break
+
+                ranges.append((start, position + 1))
+                start = position + 1
+
+    return ranges
+
+def iter_mbox(fileName, start = 0, end = None):
+    # Yields the entities of one message at a time, so only the message
+    # currently being parsed is kept in memory, whatever the archive size.
     base     = os.path.basename(fileName)
     category = '/MailBox/' + ('.').join(base.split('.')[:-1])
 
-    for entry in messages:
+    for offset, length, entry in read_mbox(fileName, start, end):
         message = MboxParser(entry)
 
         if (message.isLabelSet('Chat')):
-            result.append(_parse_conversation(message))
+            entries = [_parse_conversation(message)]
         else:
-            result.extend(_parse_message(message, category))
+            entries = _parse_message(message, category)
+
+        entries.extend(getAddressEntries(message.getId(), [
+            ('from', message.getSender()), ('to', message.getReceivers()), ('cc', message.getCc())]))
+
+        # The range covers the "From " line, it can be parsed again with read_mbox
+        source = MessageSource()
+        source.message_id = message.getId()
+        source.path       = fileName
+        source.offset     = offset
+        source.length     = length
+        entries.append(source)
+
+        yield entries
+
+def parse_mbox(fileName):
+    result   = []
+
+    for entries in iter_mbox(fileName):
+        result.extend(entries)
 
     return result
 
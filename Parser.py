@@ -1,7 +1,54 @@
 from EmlParser import parse_eml
+from EmlParser import parse_eml_message
+from EmlParser import EmlParser
 from MboxParser import parse_mbox
+from MboxParser import iter_mbox
+from MboxParser import split_mbox
 from dataTypes import *
+from commons import getFileHash
+import instrumentation
+import multiprocessing
+import collections
+import itertools
 import pathlib
+import time
+import os
+
+class ImportProgress():
+    def __init__(self, filesTotal = 0, bytesTotal = 0):
+        self.filesTotal       = filesTotal
+        self.bytesTotal       = bytesTotal
+        self.filesScanned     = 0
+        self.bytesProcessed   = 0
+        self.messagesParsed   = 0
+        self.messagesInserted = 0
+        self.cancelled        = False
+        self.startTime        = time.monotonic()
+        # Stage timings, for instrumented imports
+        self.report           = None
+
+    def elapsed(self):
+        return time.monotonic() - self.startTime
+
+    def parsedPerSecond(self):
+        return self.messagesParsed / max(self.elapsed(), 1e-6)
+
+    def insertedPerSecond(self):
+        return self.messagesInserted / max(self.elapsed(), 1e-6)
+
+    def eta(self):
+        # Seconds left, extrapolated from the bytes processed so far
+        if self.bytesProcessed == 0:
+            return None
+
+        return self.elapsed() * (self.bytesTotal - self.bytesProcessed) / self.bytesProcessed
+
+    def __str__(self):
+        eta = self.eta()
+        return '%d/%d files, %d/%d MB, %d messages parsed (%.0f/s), %d inserted (%.0f/s), ETA %s' % (
+            self.filesScanned, self.filesTotal, self.bytesProcessed >> 20, self.bytesTotal >> 20,
+            self.messagesParsed, self.parsedPerSecond(), self.messagesInserted, self.insertedPerSecond(),
+            '?' if eta is None else '%ds' % eta)
 
 def parseEmailFile(path, fileType):
     if fileType == 'eml':
@@ -9,43 +56,298 @@ def parseEmailFile(path, fileType):
     elif fileType == 'mbox':
         return parse_mbox(path)
 
-def parseEmailFolder(db, dirname, entryType):
-    failed = []
+def iterEmailFile(path, fileType):
+    if fileType == 'eml':
+        yield from parse_eml(path)
+    elif fileType == 'mbox':
+        for entries in iter_mbox(path):
+            yield from entries
+
+# Bytes hashed at the end of the parsed part of a mbox, to recognize it later
+mboxTailSize = 1 << 16
+
+# Size of the parts a mbox is split in, to be parsed by several processes
+mboxRangeSize = 16 << 20
+
+def _mboxTailHash(path, end):
+    return getFileHash(path, max(0, end - mboxTailSize), end)
+
+def _planFiles(db, paths, entryType):
+    # Yields (path, start, size, mtime, hash) for the files to parse from the
+    # start offset on. Files whose size and modification time match the
+    # manifest are skipped without being opened, for the ones only touched
+    # start is None and just their manifest entry is updated.
+    for path in paths:
+        stat   = os.stat(path)
+        known  = db.getImportedFile(path)
+        start  = 0
+        hash   = ''
+
+        if known is not None and known.size == stat.st_size and known.mtime == stat.st_mtime_ns:
+            continue
+
+        if entryType == 'mbox':
+            hash = _mboxTailHash(path, stat.st_size)
+
+            # Messages were only appended since the last import, or the file
+            # was only touched and just its manifest entry is updated
+            if known is not None and stat.st_size > known.parsed_bytes and \
+               _mboxTailHash(path, known.parsed_bytes) == known.content_hash:
+                start = known.parsed_bytes
+            elif known is not None and stat.st_size == known.parsed_bytes and hash == known.content_hash:
+                start = None
+        elif known is not None:
+            hash = getFileHash(path)
+
+            if hash == known.content_hash:
+                start = None
+
+        yield (path, start, stat.st_size, stat.st_mtime_ns, hash)
+
+def _parseEml(path):
+    # The hash of the file comes with the parsing, it is only known up front
+    # for files already in the manifest.
+    start   = time.perf_counter()
+    message = EmlParser(path)
+    entries = parse_eml_message(message, path)
+
+    instrumentation.recordFile(path, time.perf_counter() - start)
+    return (entries, message.getContentHash())
+
+def _parseEmlWorker(path):
+    # The measurements of the worker go back along with the entities
+    entries, hash = _parseEml(path)
+    return (entries, hash, instrumentation.collect())
+
+def _parseFiles(plans, entryType, workers, startMethod = None):
+    # Yields every file to parse with its entities and its content hash
+    if entryType == 'eml' and workers > 1:
+        yield from _parseEmlFiles(plans, workers, startMethod)
+        return
+
+    if entryType == 'mbox' and workers > 1:
+        yield from _parseMboxFiles(plans, workers, startMethod)
+        return
+
+    for plan in plans:
+        path, start, size, mtime, hash = plan
+
+        if start is None:
+            yield (plan, [], hash)
+        elif entryType == 'eml':
+            entries, hash = _parseEml(path)
+            yield (plan, entries, hash)
+        elif entryType == 'mbox':
+            # Entries are streamed from the parser straight into the database,
+            # so a whole mbox file is never held in memory at once.
+            entries = itertools.chain.from_iterable(_timedParse(path, iter_mbox(path, start, size)))
+            yield (plan, entries, hash)
+
+def _pool(workers, startMethod = None):
+    # Forking a process with threads running, like a GUI, copies their locks
+    # in whatever state they are, callers with threads ask for 'spawn' instead.
+    context = multiprocessing.get_context(startMethod)
+    return context.Pool(workers, instrumentation.enable, (instrumentation.enabled,))
+
+def _parseEmlFiles(plans, workers, startMethod = None):
+    # Worker processes only parse, the entities are sent back to this process
+    # which is the only one talking to the database. The files are handed out
+    # in windows, so the parsed results can't pile up faster than we insert.
+    window = workers * 16
+    plans  = iter(plans)
+
+    with _pool(workers, startMethod) as pool:
+        while True:
+            chunk = list(itertools.islice(plans, window))
+            if not chunk:
+                break
+
+            paths = [plan[0] for plan in chunk if plan[1] is not None]
+            parsed = pool.imap(_parseEmlWorker, paths)
+
+            # imap keeps the order of the files, as for a serial import
+            for plan in chunk:
+                if plan[1] is None:
+                    yield (plan, [], plan[4])
+                else:
+                    entries, hash, measurements = next(parsed)
+                    instrumentation.merge(measurements)
+                    yield (plan, entries, hash)
+
+def _timedParse(path, messages):
+    # Records the time spent parsing the file, but not the time the consumer
+    # spends between the messages, e.g. flushing them to the database.
+    parsed   = 0.0
+    messages = iter(messages)
+
+    while True:
+        start   = time.perf_counter()
+        entries = next(messages, None)
+        parsed += time.perf_counter() - start
+
+        if entries is None:
+            break
+
+        yield entries
 
-    messageIds = set(db.getMessageIds())
-    conversationsIds = set(db.getConversationIds())
+    instrumentation.recordFile(path, parsed)
 
-    for path in pathlib.Path(dirname).rglob('*.' + entryType):
-        # Iup, seems like a redundant parameter :)
-        entries = parseEmailFile(str(path), entryType)
+def _parseMboxRange(path, start, end):
+    started = time.perf_counter()
+    entries = list(itertools.chain.from_iterable(iter_mbox(path, start, end)))
+    return (entries, time.perf_counter() - started, instrumentation.collect())
+
+def _parseMboxRanges(pool, path, ranges, window):
+    # Yields the entities of the ranges in the order of the file, while the
+    # next window of ranges is being parsed.
+    ranges  = iter(ranges)
+    pending = collections.deque()
+    parsed  = 0.0
+
+    for start, end in itertools.islice(ranges, window):
+        pending.append(pool.apply_async(_parseMboxRange, (path, start, end)))
+
+    while pending:
+        entries, seconds, measurements = pending.popleft().get()
+        parsed += seconds
+
+        for start, end in itertools.islice(ranges, 1):
+            pending.append(pool.apply_async(_parseMboxRange, (path, start, end)))
+
+        instrumentation.merge(measurements)
+        yield from entries
+
+    # The parsing time of the file, summed over its ranges
+    instrumentation.recordFile(path, parsed)
+
+def _parseMboxFiles(plans, workers, startMethod = None):
+    # A mbox is split at message boundaries in ranges parsed by the workers,
+    # only a couple of ranges per worker are parsed ahead of the inserts.
+    with _pool(workers, startMethod) as pool:
+        for plan in plans:
+            path, start, size, mtime, hash = plan
+
+            if start is None:
+                yield (plan, [], hash)
+            else:
+                ranges = split_mbox(path, start, size, mboxRangeSize)
+                yield (plan, _parseMboxRanges(pool, path, ranges, workers * 2), hash)
+
+def _trackProgress(files, progress, cancel):
+    for (path, start, size, mtime, hash), entries, contentHash in files:
+        processed = progress.bytesProcessed
 
         for entry in entries:
+            if cancel is not None and cancel.is_set():
+                progress.cancelled = True
+                return
+
+            if isinstance(entry, Message) or isinstance(entry, Conversation):
+                progress.messagesParsed += 1
+            elif isinstance(entry, MessageSource):
+                # Bytes go up per message, a single large mbox is the whole import
+                progress.bytesProcessed = processed + entry.offset + entry.length - (start or 0)
+
+            yield entry
+
+        progress.filesScanned   += 1
+        progress.bytesProcessed  = processed + size - (start or 0)
+
+        # Written with the last batch of the file, so a file is only marked
+        # as imported along with its messages.
+        record = ImportedFile()
+        record.file_id      = path
+        record.size         = size
+        record.mtime        = mtime
+        record.content_hash = contentHash
+        record.parsed_bytes = size
+        yield record
+
+def parseEmailFolder(db, dirname, entryType, batchSize = 1000, workers = 1, pragmas = None, deferIndexes = False,
+                     onProgress = None, cancel = None, instrument = False, profile = None, profileFile = None,
+                     startMethod = None):
+    # onProgress is called with the progress after every committed batch and
+    # setting the cancel event stops the import after the current entry.
+    # instrument puts the time spent per stage in progress.report, profile runs the import
+    # under 'cprofile' or 'tracemalloc' and writes the dump to profileFile.
+    # startMethod is the multiprocessing start method of the parsing workers.
+    if instrument:
+        instrumentation.reset()
+        instrumentation.enable()
+
+    try:
+        with instrumentation.profiled(profile, profileFile or 'import.' + str(profile)):
+            progress = _importFolder(db, dirname, entryType, batchSize, workers, pragmas, deferIndexes, onProgress, cancel,
+                                     startMethod)
+    finally:
+        if instrument:
+            instrumentation.enable(False)
+
+    if instrument:
+        progress.report = instrumentation.report()
+
+    return progress
 
-            # Filter inserted id's to avoid the sql unique id error
-            # Should make sure the id's I'm using are ok and probably
-            # avoid these checks for emls
-            if isinstance(entry, Message) or isinstance(entry, Attachment):
-               if entry.message_id in messageIds:
-                   continue
-               # Ugly trick to share the same list. (attachments are added before)
-               if isinstance(entry, Message):
-                   messageIds.add(entry.message_id)
-
-            if isinstance(entry, Conversation):
-               id = (int(entry.thread_id), int(entry.conversation_id))
-
-               if id in conversationsIds:
-                   continue
-
-               conversationsIds.add(id)
-              
-            try:
-                db.insert(entry)
-            except Exception as err:
-                print("Back to the drawing board: {0} for {1}".format(err, entry))
+def _importFolder(db, dirname, entryType, batchSize, workers, pragmas, deferIndexes, onProgress, cancel, startMethod):
+    failed = []
+
+    # Maintaining the indexes row by row is slower than building them once
+    # at the end. New databases have none yet, so this is only for re-imports.
+    if deferIndexes:
+        db.dropIndexes()
+
+    # Messages already in the database are left as they are by the inserts,
+    # unchanged files aren't even parsed.
+    paths = [os.path.abspath(path) for path in pathlib.Path(dirname).rglob('*.' + entryType)]
+    plans = list(_planFiles(db, paths, entryType))
+
+    progress = ImportProgress(len(plans), sum(size - (start or 0) for path, start, size, mtime, hash in plans))
+
+    def onFlush(entries, inserted):
+        # Messages already in the database are ignored by the inserts
+        progress.messagesInserted += inserted.get('Message', 0) + inserted.get('Conversation', 0)
+        if onProgress is not None:
+            onProgress(progress)
+
+    entries = _trackProgress(_parseFiles(plans, entryType, workers, startMethod), progress, cancel)
+    db.insertStream(entries, batchSize, pragmas, onFlush)
 
     if len(failed) > 0:
         print ("Failed adding : " + ','.join(failed))
 
     if entryType == 'mbox':
         db.groupConversations()
+
+    db.createIndexes()
+
+    if onProgress is not None:
+        onProgress(progress)
+
+    return progress
+
+def parseMessageSource(db, message_id):
+    # Parses a single message again from its source file, e.g. with a newer
+    # parser, without scanning the rest of the file.
+    for path, offset, length in db.connection.execute(
+            'SELECT path, offset, length FROM MessageSource where message_id = ?', (message_id,)):
+        if path.endswith('.mbox'):
+            return list(itertools.chain.from_iterable(iter_mbox(path, offset, offset + length)))
+
+        return parse_eml(path)
+
+    return []
+
+def migrateMessageIds(db, dirname, batchSize = 1000):
+    # Databases imported before the Message-ID based ids use a hash of the
+    # pickled message, the eml files are read again to map one on the other.
+    mapping = []
+
+    for path in pathlib.Path(dirname).rglob('*.eml'):
+        message = EmlParser(str(path))
+        mapping.append((message.getLegacyId(), message.getId()))
+
+        if len(mapping) >= batchSize:
+            db.remapMessageIds(mapping)
+            mapping = []
+
+    db.remapMessageIds(mapping)
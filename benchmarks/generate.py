@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+# Deterministic generator of synthetic archives: Zimbra style eml trees with
+# their .meta files and Gmail style mbox files with chats and attachments.
+# The same seed and size always produce the same bytes.
+
+from email.message import EmailMessage
+from email.utils import format_datetime
+
+import datetime
+import json
+import os
+import random
+import sys
+
+folders   = ['/Inbox', '/Inbox/Work', '/Inbox/Family', '/Sent', '/Archive/2019', '/Archive/2020']
+labels    = ['Inbox', 'Sent', 'Important', 'Starred', 'Work', 'Travel']
+words     = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore '
+             'et dolore magna aliqua invoice meeting report holiday budget release schedule quick brown fox').split()
+# Attachment sizes, from icons to scanned documents, and how common they are
+attachmentSizes   = [200, 4 << 10, 60 << 10, 500 << 10, 2 << 20]
+attachmentWeights = [40, 30, 20, 8, 2]
+
+def _address(generator):
+    name = generator.choice(['alice', 'bob', 'carol', 'dave', 'erin', 'frank', 'grace', 'heidi'])
+    return '%s%d@example.%s' % (name, generator.randrange(50), generator.choice(['com', 'org', 'net']))
+
+def _text(generator, count):
+    return ' '.join(generator.choice(words) for i in range(count))
+
+def _date(generator):
+    return datetime.datetime(2015 + generator.randrange(8), 1 + generator.randrange(12), 1 + generator.randrange(28),
+                             generator.randrange(24), generator.randrange(60), generator.randrange(60),
+                             tzinfo = datetime.timezone.utc)
+
+def _message(generator, index, attachments = True):
+    date = _date(generator)
+
+    message = EmailMessage()
+    message['From']       = '"%s" <%s>' % (_text(generator, 2).title(), _address(generator))
+    message['To']         = ', '.join(_address(generator) for i in range(1 + generator.randrange(3)))
+    message['Subject']    = _text(generator, 3 + generator.randrange(6)).capitalize()
+    message['Date']       = format_datetime(date)
+    message['Message-ID'] = '<bench%d.%d@example.com>' % (index, generator.randrange(1 << 30))
+
+    body = _text(generator, 20 + generator.randrange(400))
+    message.set_content(body)
+    message.add_alternative('<html><body><p>%s</p></body></html>' % body, subtype = 'html')
+
+    # About one message in five has attachments
+    while attachments and generator.random() < 0.2:
+        size = generator.choices(attachmentSizes, attachmentWeights)[0]
+        data = generator.randbytes(size)
+        message.add_attachment(data, maintype = 'application', subtype = 'octet-stream',
+                               filename = '%s.bin' % generator.choice(words))
+
+    return message, date
+
+def generateEml(dirname, count, seed = 0):
+    generator = random.Random(seed)
+
+    for index in range(count):
+        folder = generator.choice(folders)
+        path = os.path.join(dirname, folder.strip('/'))
+        os.makedirs(path, exist_ok = True)
+
+        message, date = _message(generator, index)
+        fileName = os.path.join(path, '%d.eml' % index)
+
+        with open(fileName, 'wb') as file:
+            file.write(bytes(message))
+
+        with open(fileName + '.meta', 'w') as file:
+            json.dump({'Path': folder, 'Flags': 'u' if generator.random() < 0.3 else ''}, file)
+
+def generateMbox(fileName, count, seed = 0):
+    generator = random.Random(seed)
+    threadId  = None
+
+    os.makedirs(os.path.dirname(fileName) or '.', exist_ok = True)
+
+    with open(fileName, 'wb') as file:
+        for index in range(count):
+            messageId = (1 << 60) + index
+            chat = generator.random() < 0.25
+
+            message, date = _message(generator, index, not chat)
+
+            # Chat lines come in threads of a few lines
+            if chat:
+                if threadId is None or generator.random() < 0.3:
+                    threadId = messageId
+                message['X-GM-THRID']     = str(threadId)
+                message['X-Gmail-Labels'] = 'Chat'
+            else:
+                message['X-GM-THRID']     = str(messageId)
+                message['X-Gmail-Labels'] = ','.join(generator.sample(labels, 1 + generator.randrange(2)) +
+                                                     (['Unread'] if generator.random() < 0.3 else []))
+
+            # Gmail's From line, the message id followed by the date
+            file.write(b'From %d@xxx %s\n' % (messageId, date.strftime('%a %b %d %H:%M:%S +0000 %Y').encode('ascii')))
+
+            data = bytes(message).replace(b'\r\n', b'\n').replace(b'\nFrom ', b'\n>From ')
+            file.write(data + b'\n')
+
+def generateCorpus(dirname, count, seed = 0):
+    # Returns the eml folder and the mbox folder of the corpus
+    emlFolder  = os.path.join(dirname, 'eml')
+    mboxFolder = os.path.join(dirname, 'mbox')
+
+    generateEml(emlFolder, count, seed)
+    generateMbox(os.path.join(mboxFolder, 'All mail.mbox'), count, seed)
+
+    return emlFolder, mboxFolder
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4):
+        print('Usage: ' + sys.argv[0] + ' folder messages [seed]')
+        exit(-1)
+
+    generateCorpus(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]) if len(sys.argv) == 4 else 0)
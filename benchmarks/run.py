@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+
+# Times the parsers, the import and the queries over generated corpora of
+# several sizes. The results are written as JSON, and compared against a
+# previous run when a baseline is given.
+
+import argparse
+import copy
+import json
+import os
+import pathlib
+import platform
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from generate import generateCorpus
+
+from EmlParser import parse_eml
+from MboxParser import parse_mbox
+from Parser import parseEmailFolder
+from database import Database
+
+# Values of the getMessages filters, all present in the generated corpora
+messageFilters = {
+    'category'   : '/Inbox',
+    'recipients' : 'alice1',
+    'sender'     : 'bob',
+    'subject'    : 'invoice',
+    'content'    : 'quick brown'
+}
+
+def measure(function, repeat, setup = None):
+    # Runs the function repeat times, returning the timings and the last result.
+    # The result of setup, run untimed before each run, is passed to the function.
+    timings = []
+
+    for run in range(repeat):
+        arguments = [setup()] if setup else []
+
+        start  = time.perf_counter()
+        result = function(*arguments)
+        timings.append(time.perf_counter() - start)
+
+    return timings, result
+
+def _freshDatabase(folder, name):
+    fileName = os.path.join(folder, name)
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(fileName + suffix):
+            os.remove(fileName + suffix)
+
+    return Database(fileName)
+
+def _importFolders(folder, emlFolder, mboxFolder):
+    db = _freshDatabase(folder, 'import.db')
+    parseEmailFolder(db, emlFolder, 'eml')
+    parseEmailFolder(db, mboxFolder, 'mbox')
+    return db
+
+def _insertAll(folder, entries):
+    db = _freshDatabase(folder, 'insert.db')
+    for entry in entries:
+        db.insert(entry)
+    db.connection.commit()
+    return db
+
+def _readAttachments(db, attachments):
+    return sum(len(db.getAttachmentData(message_id, name) or b'') for message_id, name in attachments)
+
+def runBenchmarks(folder, size, repeat, seed):
+    emlFolder, mboxFolder = generateCorpus(os.path.join(folder, 'corpus'), size, seed)
+    emlFiles  = sorted(str(path) for path in pathlib.Path(emlFolder).rglob('*.eml'))
+    mboxFiles = sorted(str(path) for path in pathlib.Path(mboxFolder).rglob('*.mbox'))
+
+    results = {}
+
+    def record(name, timings, items):
+        results[name] = {
+            'best'   : min(timings),
+            'median' : statistics.median(timings),
+            'runs'   : len(timings),
+            'items'  : items
+        }
+        print('%6d %-28s %10.4fs %8d items' % (size, name, min(timings), items))
+
+    timings, entries = measure(lambda: [entry for fileName in emlFiles for entry in parse_eml(fileName)], repeat)
+    record('parse_eml', timings, len(emlFiles))
+    emlEntries = entries
+
+    timings, entries = measure(lambda: [entry for fileName in mboxFiles for entry in parse_mbox(fileName)], repeat)
+    record('parse_mbox', timings, len(entries))
+
+    # Fresh entries for every run, the ones inserted already went through a database
+    timings, db = measure(lambda entries: _insertAll(folder, entries), repeat,
+                          lambda: copy.deepcopy(emlEntries + entries))
+    record('Database.insert', timings, len(emlEntries) + len(entries))
+
+    timings, db = measure(lambda: _importFolders(folder, emlFolder, mboxFolder), repeat)
+    record('parseEmailFolder', timings, len(emlFiles) + len(mboxFiles))
+
+    for name, value in messageFilters.items():
+        timings, rows = measure(lambda: list(db.getMessages(**{name: value})), repeat)
+        record('getMessages.' + name, timings, len(rows))
+
+    timings, rows = measure(lambda: list(db.getMessages()), repeat)
+    record('getMessages', timings, len(rows))
+
+    # The year 2019 of the generated dates, as UTC timestamps
+    timings, rows = measure(lambda: list(db.getMessages(since = 1546300800, until = 1577836800)), repeat)
+    record('getMessages.range', timings, len(rows))
+
+    threads = db.connection.execute('SELECT count(distinct(thread_id)) FROM Conversation').fetchone()[0]
+    timings, result = measure(lambda: db.groupConversations(True), repeat)
+    record('groupConversations', timings, threads)
+
+    attachments = db.connection.execute('SELECT message_id, attachment_id FROM Attachment').fetchall()
+    timings, result = measure(lambda: _readAttachments(db, attachments), repeat)
+    record('getAttachmentData', timings, len(attachments))
+
+    return results
+
+def compareResults(results, baseline, threshold, minimumTime = 0.005):
+    # Returns the benchmarks slower than the baseline by more than the
+    # threshold, ignoring the ones too short to be timed reliably
+    regressions = []
+
+    for size, benchmarks in results['results'].items():
+        for name, result in benchmarks.items():
+            reference = baseline.get('results', {}).get(size, {}).get(name)
+            if reference is None or reference['best'] <= 0:
+                continue
+
+            ratio = result['best'] / reference['best']
+            print('%6s %-28s %10.4fs -> %10.4fs %+7.1f%%' % (size, name, reference['best'], result['best'], 100 * (ratio - 1)))
+
+            if ratio > 1 + threshold and result['best'] >= minimumTime:
+                regressions.append((size, name, ratio))
+
+    return regressions
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser(description = 'Benchmarks of the import and the queries')
+    arguments.add_argument('--sizes', default = '100,1000', help = 'comma separated corpus sizes, in messages per format')
+    arguments.add_argument('--repeat', type = int, default = 3, help = 'runs of each benchmark, the best one is compared')
+    arguments.add_argument('--seed', type = int, default = 0)
+    arguments.add_argument('--output', default = 'benchmark.json', help = 'file the results are written to')
+    arguments.add_argument('--baseline', help = 'results of a previous run to compare against')
+    arguments.add_argument('--threshold', type = float, default = 0.2, help = 'slowdown reported as a regression')
+    options = arguments.parse_args()
+
+    results = {
+        'python'   : platform.python_version(),
+        'sqlite'   : sqlite3.sqlite_version,
+        'platform' : platform.platform(),
+        'seed'     : options.seed,
+        'repeat'   : options.repeat,
+        'results'  : {}
+    }
+
+    for size in [int(size) for size in options.sizes.split(',')]:
+        with tempfile.TemporaryDirectory(prefix = 'candycane-bench-') as folder:
+            results['results'][str(size)] = runBenchmarks(folder, size, options.repeat, options.seed)
+
+    with open(options.output, 'w') as file:
+        json.dump(results, file, indent = 2, sort_keys = True)
+
+    if options.baseline:
+        with open(options.baseline) as file:
+            regressions = compareResults(results, json.load(file), options.threshold)
+
+        for size, name, ratio in regressions:
+            print('Regression: %s at %s messages is %.2fx slower' % (name, size, ratio))
+
+        if regressions:
+            exit(1)
@@ -1,18 +1,190 @@
+from email.utils import getaddresses
+from email.utils import parsedate_to_datetime
+
+import calendar
 import re
 import pickle
 import hashlib
 
+from dataTypes import Address
+from dataTypes import MessageAddress
+
+# A plain address, e.g. alice@example.com
+emailPattern = re.compile(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9._-]+\.[a-zA-Z0-9_-]+')
+
 def readFile(filename):
     with open(filename, 'rb') as file:
         blobData = file.read()
     return blobData
 
-def extractEmails(text):
-    emails = re.findall('([a-zA-Z0-9._-]+@[a-zA-Z0-9._-]+\.[a-zA-Z0-9_-]+)', text)
-    emails = list(dict.fromkeys(emails))
-    return emails
+def getFileHash(filename, start = 0, end = None):
+    # Hash of the bytes of the file between the start and end offsets
+    h = hashlib.sha1()
+
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        left = (end - start) if end is not None else None
+
+        while left is None or left > 0:
+            chunk = file.read(1 << 16 if left is None else min(left, 1 << 16))
+            if not chunk:
+                break
+            h.update(chunk)
+            if left is not None:
+                left -= len(chunk)
+
+    return h.hexdigest()
+
+def extractEmails(header):
+    # Addresses of an address header, in order and without duplicates. The
+    # header is parsed, so commas and @ in display names are no problem.
+    if header is None:
+        return []
+
+    emails = []
+
+    for name, address in getaddresses([str(header)]):
+        if emailPattern.fullmatch(address):
+            emails.append(address)
+        else:
+            # Malformed entries may still hold an address
+            emails.extend(emailPattern.findall(address))
+
+    return list(dict.fromkeys(emails))
+
+def parseDate(text):
+    # Display date of the message, as written in its time zone, and the UTC
+    # epoch seconds it is ordered by. email.utils reads both the RFC 2822
+    # dates and the ones of the mbox From lines, dateutil is only loaded for
+    # the odd formats it doesn't know. Dates without a zone are taken as UTC.
+    # Missing or unreadable dates give an empty date and no timestamp.
+    if text is None or not str(text).strip():
+        return '', None
+
+    try:
+        dt = parsedate_to_datetime(str(text))
+    except (TypeError, ValueError, IndexError):
+        try:
+            from dateutil.parser import parse
+            dt = parse(str(text))
+        except (ValueError, OverflowError):
+            return '', None
+
+    try:
+        timestamp = calendar.timegm(dt.utctimetuple())
+    except (ValueError, OverflowError):
+        return '', None
+
+    return str(dt.date()) + ' ' + str(dt.time()), timestamp
+
+def getAddressId(address):
+    return getHashOfBytes(address.lower().encode('utf-8'))
+
+def getAddressEntries(message_id, roles):
+    # Address and MessageAddress entities linking the message to the
+    # addresses of every role, e.g. [('from', [...]), ('to', [...])]
+    result = []
+
+    for role, addresses in roles:
+        for address in addresses:
+            entry = Address()
+            entry.address_id = getAddressId(address)
+            entry.address    = address.lower()
+            result.append(entry)
+
+            link = MessageAddress()
+            link.message_id = message_id
+            link.address_id = entry.address_id
+            link.role       = role
+            result.append(link)
+
+    return result
+
+def walkParts(part):
+    # Leaf parts of the MIME tree. A forwarded message is a leaf too, its
+    # bodies and attachments are not the ones of the message around it.
+    if part.get_content_maintype() == 'multipart' and part.is_multipart():
+        for child in part.get_payload():
+            yield from walkParts(child)
+    else:
+        yield part
+
+def isForwarded(part):
+    return part.get_content_type() == 'message/rfc822'
+
+def getPartData(part):
+    # Decoded bytes of a leaf part, a forwarded message is kept as an eml
+    if isForwarded(part) and part.is_multipart():
+        return b''.join(message.as_bytes() for message in part.get_payload())
+
+    return part.get_payload(decode=True)
+
+def uniqueName(name, seen):
+    # Names the n-th "name.ext" of a message "name (n).ext"
+    unique = name
+    stem, dot, extension = name.rpartition('.')
+
+    if not stem:
+        stem, dot, extension = name, '', ''
+
+    count = 1
+    while unique in seen:
+        count += 1
+        unique = '%s (%d)%s%s' % (stem, count, dot, extension)
+
+    seen.add(unique)
+    return unique
+
+def decodeBody(data):
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+def extractParts(message, decodeName = str):
+    # A single walk over the MIME tree collects both bodies and all the
+    # attachments, instead of one walk per attachment. Returns the first non
+    # empty html and plain bodies, and the (name, data) of the attachments.
+    # Parts with a file name, marked as attachments or forwarded are all
+    # attachments, decodeName reads the names as the parser stores them.
+    html        = ''
+    plain       = ''
+    attachments = []
+    seen        = set()
+
+    for part in walkParts(message):
+        name = part.get_filename()
+
+        if name is None and isForwarded(part):
+            name = 'message.eml'
+        elif name is None and part.get_content_disposition() == 'attachment':
+            name = 'attachment'
+
+        if name is not None:
+            attachments.append((uniqueName(decodeName(name), seen), getPartData(part)))
+            continue
+
+        contentType = part.get_content_type()
+
+        if contentType == 'text/html' and not html:
+            html = decodeBody(part.get_payload(decode=True))
+        elif contentType == 'text/plain' and not plain:
+            plain = decodeBody(part.get_payload(decode=True))
+
+    return html, plain, attachments
 
 def getHashOfItem(item):
     h = hashlib.sha1()
     h.update(pickle.dumps(item))
     return int(h.hexdigest(), 16) % (1 << 63)
+
+def getContentHash(data):
+    # Key of the content addressed attachment store
+    return hashlib.sha256(data).hexdigest()
+
+def getHashOfBytes(data):
+    return getHashOfDigest(hashlib.sha1(data))
+
+def getHashOfDigest(digest):
+    # Same 63 bits range as getHashOfItem, so it fits a sqlite integer
+    return int(digest.hexdigest(), 16) % (1 << 63)
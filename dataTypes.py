@@ -5,19 +5,25 @@ class Message():
         self.recipients      = ""
         self.subject         = ""
         self.date            = ""
-        self.content         = ""
-        self.rich_content    = ""
+        # UTC epoch seconds of the date, what the listings are ordered by
+        self.timestamp       = None
         self.has_attachments = 0
         self.category        = ""
         self.is_conversation = 0
+        self.is_unread       = 0
 
     def __str__(self):
         return 'Message[' + str(self.message_id) + '] = {' + str(self.sender) + ', ' + str(self.sender) + ', ' + str(self.subject) + '}'
 
+# Bodies of the messages, kept apart so listings don't read through them
 class Content():
     def __init__(self):
-        self.message_id = 0
-        self.content    = ""
+        self.message_id   = 0
+        self.content      = ""
+        self.rich_content = ""
+
+    def __str__(self):
+        return 'Content[' + str(self.message_id) + ']'
 
 class Messages(Message):
     def __init__(self):
@@ -28,6 +34,7 @@ class Conversation():
         self.thread_id       = 0
         self.conversation_id = 0
         self.date            = ""
+        self.timestamp       = None
         self.participants    = ""
         self.content         = ""
 
@@ -43,23 +50,133 @@ class Attachment():
         self.message_id    = 0
         self.attachment_id = ""
         self.data          = ""
+        # Key of the data in the Blob table, data is then empty
+        self.data_hash     = ""
 
     def __str__(self):
         return 'Attachment[' + str(self.message_id) + '] = {' + self.attachment_id + '}'
 
+class Blob():
+    def __init__(self):
+        self.blob_id  = ""
+        self.size     = 0
+        self.refcount = 0
+        self.data     = b""
+
+class ImportedFile():
+    # Manifest of the imported files, file_id being the path of the file.
+    # For mbox files the hash only covers the bytes before parsed_bytes, to
+    # recognize a file that was only appended to.
+    def __init__(self):
+        self.file_id      = ""
+        self.size         = 0
+        self.mtime        = 0
+        self.content_hash = ""
+        self.parsed_bytes = 0
+
+    def __str__(self):
+        return 'ImportedFile[' + self.file_id + ']'
+
+# Where the raw source of a message is, so it can be read back without
+# keeping a copy of the archive in the database
+class MessageSource():
+    def __init__(self):
+        self.message_id = 0
+        self.path       = ""
+        self.offset     = 0
+        self.length     = 0
+
+    def __str__(self):
+        return 'MessageSource[' + str(self.message_id) + '] = {' + self.path + ', ' + str(self.offset) + ', ' + str(self.length) + '}'
+
+# Addresses found in the messages, address_id being a hash of the address
+class Address():
+    def __init__(self):
+        self.address_id = 0
+        self.address    = ""
+
+# Links the messages to their addresses, with the header they were in:
+# from, to or cc
+class MessageAddress():
+    def __init__(self):
+        self.message_id = 0
+        self.address_id = 0
+        self.role       = ""
+
+# Message counts of every category, kept up to date by triggers on Message.
+# The counts don't include the sub categories.
+class Category():
+    def __init__(self):
+        self.category_id = ""
+        self.messages    = 0
+        self.unread      = 0
+        self.attachments = 0
+
+# Chat threads with new lines since their conversation message was built
+class PendingThread():
+    def __init__(self):
+        self.thread_id = 0
+
+# Settings of the database, e.g. the codec of the message bodies
+class Setting():
+    def __init__(self):
+        self.setting_id = ""
+        self.value      = ""
+
 databaseAttrTypes = {
     "message_id"      : "BIGINT",
     "conversation_id" : "BIGINT",
     "thread_id"       : "BIGINT",
+    "address_id"      : "BIGINT",
+    "timestamp"       : "INTEGER",
     "has_attachments" : "INTEGER",
-    "has_attachments" : "INTEGER"
+    "size"            : "INTEGER",
+    "refcount"        : "INTEGER",
+    "mtime"           : "INTEGER",
+    "parsed_bytes"    : "INTEGER",
+    "is_unread"       : "INTEGER",
+    "offset"          : "INTEGER",
+    "length"          : "INTEGER",
+    "messages"        : "INTEGER",
+    "unread"          : "INTEGER",
+    "attachments"     : "INTEGER"
+}
+
+# Tables where an insert replaces the row with the same key, in the others
+# the rows already present are kept.
+databaseReplaceTables = [
+    'MessageSource',
+    'ImportedFile',
+    'Setting'
+]
+
+# Primary keys other than the attributes ending in _id
+databasePrimaryKeys = {
+    'MessageAddress' : ['message_id', 'role', 'address_id']
+}
+
+# Secondary indexes, created once the bulk of the data is in place.
+# The primary keys already cover Attachment.message_id and Conversation.thread_id.
+databaseIndexes = {
+    "MessageTimestamp"         : ("Message", ["timestamp", "message_id"]),
+    "MessageCategoryTimestamp" : ("Message", ["category", "timestamp", "message_id"]),
+    "MessageConversation"      : ("Message", ["is_conversation"]),
+    "AddressMessage"           : ("MessageAddress", ["address_id", "role", "message_id"])
 }
 
 databaseTables = [
     'Message',
     'Conversation',
     'Attachment',
+    'Blob',
     'Content',
+    'MessageSource',
+    'Address',
+    'MessageAddress',
+    'Category',
     'Messages',
-    'Conversations'
+    'Conversations',
+    'PendingThread',
+    'ImportedFile',
+    'Setting'
 ]
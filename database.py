@@ -1,54 +1,652 @@
 import dataTypes
+import collections
+import functools
+import operator
 import sqlite3
+import mmap
+import zlib
+import sys
+import os
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
 
 from dataTypes import *
+from commons import getContentHash
+from commons import getAddressId
+from commons import getAddressEntries
+from commons import emailPattern
+from instrumentation import timed
+
+# Pragmas used while bulk importing. They trade durability of the last
+# transactions for throughput, which is fine as an import can be redone.
+importPragmas = {
+    'journal_mode' : 'WAL',
+    'synchronous'  : 'OFF',
+    'cache_size'   : -256000
+}
+
+# Codecs the bodies can be stored with. A compressed body is stored as a blob
+# starting with the tag of its codec, a plain one as text, so databases can
+# mix them while being recompressed.
+bodyCodecs = {
+    'zlib' : (b'z', zlib.compress, zlib.decompress)
+}
+
+if lzma is not None:
+    bodyCodecs['lzma'] = (b'x', lzma.compress, lzma.decompress)
+
+# Columns holding message bodies
+bodyColumns = {
+    'Content'      : ['content', 'rich_content'],
+    'Conversation' : ['content']
+}
+
+def uniqueAddresses(addresses, excluded):
+    # Sorted, distinct addresses of a comma separated list, without the excluded ones
+    excluded = set((excluded or '').split(','))
+    excluded.add('')
+
+    return ','.join(sorted(set((addresses or '').split(',')) - excluded))
+
+def packBody(text, codec):
+    if codec not in bodyCodecs or not text:
+        return text
+
+    tag, compress, decompress = bodyCodecs[codec]
+    data = text.encode('utf-8')
+    packed = tag + compress(data)
+
+    # Short bodies may not get any smaller
+    return packed if len(packed) < len(data) else text
+
+def unpackBody(value):
+    if not isinstance(value, bytes):
+        return value
+
+    for tag, compress, decompress in bodyCodecs.values():
+        if value[:1] == tag:
+            return decompress(value[1:]).decode('utf-8')
+
+    raise ValueError('Unknown body codec: %r' % value[:1])
+
+# Full text index over the searchable Message columns, with the Message rowid
+# as key. It is contentless, only MATCH and rank are used and the text is
+# already in Message and Content, so it doesn't keep another copy of it.
+# Rows of a contentless table are removed with the 'delete' command and the
+# values they were indexed with, unless sqlite supports contentless_delete.
+# The triggers read the bodies with unpackBody, which only exists on the
+# connections of this module, so they are temporary triggers created on every
+# open. Other sqlite clients can still write, rebuildSearchIndex catches up.
+searchColumns = ['subject', 'sender', 'recipients', 'content']
+
+searchTableQueries = [
+    "CREATE VIRTUAL TABLE MessageSearch USING fts5(%s, content='', contentless_delete=1)" % ', '.join(searchColumns),
+    "CREATE VIRTUAL TABLE MessageSearch USING fts5(%s, content='')" % ', '.join(searchColumns)
+]
+
+searchBody = "coalesce((SELECT unpackBody(content) FROM Content WHERE message_id = %s), '')"
+
+def _searchRow(row):
+    # Index row of the old or new Message row of a trigger
+    return 'SELECT %s.rowid AS rowid, %s.subject AS subject, %s.sender AS sender, %s.recipients AS recipients, \
+                   %s AS content' % (row, row, row, row, searchBody % (row + '.message_id'))
+
+def _searchStoredRow(message_id, content, condition = ''):
+    # Index row of the message with the id, with the body given
+    return 'SELECT rowid, subject, sender, recipients, %s AS content FROM Message \
+              WHERE message_id = %s%s' % (content, message_id, condition)
+
+def searchTriggerQueries(deleteRows):
+    columns = ', '.join(searchColumns)
+
+    def insert(rows):
+        return 'INSERT INTO MessageSearch(rowid, %s) %s;' % (columns, rows)
+
+    def remove(rows):
+        # Only rows in the index are removed, the values must be the ones
+        # they were indexed with
+        if deleteRows:
+            return 'DELETE FROM MessageSearch WHERE rowid IN (SELECT rowid FROM (%s));' % rows
+
+        return "INSERT INTO MessageSearch(MessageSearch, rowid, %s) SELECT 'delete', * FROM (%s) AS Removed \
+                  WHERE EXISTS (SELECT 1 FROM MessageSearch WHERE MessageSearch.rowid = Removed.rowid);" % (columns, rows)
+
+    return [
+        """CREATE TEMP TRIGGER IF NOT EXISTS MessageSearchInsert AFTER INSERT ON Message BEGIN
+             %s
+           END""" % insert(_searchRow('new')),
+        """CREATE TEMP TRIGGER IF NOT EXISTS MessageSearchDelete AFTER DELETE ON Message BEGIN
+             %s
+           END""" % remove(_searchRow('old')),
+        """CREATE TEMP TRIGGER IF NOT EXISTS MessageSearchUpdate AFTER UPDATE OF subject, sender, recipients, message_id ON Message BEGIN
+             %s
+             %s
+           END""" % (remove(_searchRow('old')), insert(_searchRow('new'))),
+        # The body may be written before or after its message, a message
+        # without one is indexed with an empty body
+        """CREATE TEMP TRIGGER IF NOT EXISTS ContentSearchInsert AFTER INSERT ON Content BEGIN
+             %s
+             %s
+           END""" % (remove(_searchStoredRow('new.message_id', "''")),
+                     insert(_searchStoredRow('new.message_id', 'unpackBody(new.content)'))),
+        """CREATE TEMP TRIGGER IF NOT EXISTS ContentSearchUpdate AFTER UPDATE OF content, message_id ON Content
+             WHEN old.message_id IS NOT new.message_id OR unpackBody(old.content) IS NOT unpackBody(new.content) BEGIN
+             %s
+             %s
+             %s
+             %s
+           END""" % (remove(_searchStoredRow('old.message_id', 'unpackBody(old.content)')),
+                     insert(_searchStoredRow('old.message_id', searchBody % 'old.message_id')),
+                     remove(_searchStoredRow('new.message_id', "''", ' AND old.message_id IS NOT new.message_id')),
+                     insert(_searchStoredRow('new.message_id', 'unpackBody(new.content)', ' AND old.message_id IS NOT new.message_id'))),
+        """CREATE TEMP TRIGGER IF NOT EXISTS ContentSearchDelete AFTER DELETE ON Content BEGIN
+             %s
+             %s
+           END""" % (remove(_searchStoredRow('old.message_id', 'unpackBody(old.content)')),
+                     insert(_searchStoredRow('old.message_id', "''")))
+    ]
+
+# Columns of the message listings
+listColumns = ['message_id', 'sender', 'recipients', 'subject', 'date', 'has_attachments']
+# Listing columns sorted by another column, the dates by their UTC timestamp
+sortColumns = {'date' : 'timestamp'}
+
+# Filters matching a whole address use the address index, with the role of
+# the header the column comes from
+addressColumns = {
+    'sender'     : 'from',
+    'recipients' : 'to'
+}
+
+# Above this many sub categories, a page is sorted rather than merged
+maxCategoryBranches = 64
+
+# New chat lines mark their thread, to rebuild only its conversation message
+conversationTriggerQueries = [
+    """CREATE TRIGGER IF NOT EXISTS ConversationPending AFTER INSERT ON Conversation BEGIN
+         INSERT OR IGNORE INTO PendingThread (thread_id) VALUES (new.thread_id);
+       END"""
+]
+
+# Keep the message counts of the categories along with the messages
+categoryTriggerQueries = [
+    """CREATE TRIGGER IF NOT EXISTS CategoryInsert AFTER INSERT ON Message BEGIN
+         INSERT OR IGNORE INTO Category (category_id, messages, unread, attachments) VALUES (new.category, 0, 0, 0);
+         UPDATE Category SET messages    = messages + 1,
+                             unread      = unread + (coalesce(new.is_unread, 0) <> 0),
+                             attachments = attachments + (coalesce(new.has_attachments, 0) > 0)
+           WHERE category_id = new.category;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS CategoryDelete AFTER DELETE ON Message BEGIN
+         UPDATE Category SET messages    = messages - 1,
+                             unread      = unread - (coalesce(old.is_unread, 0) <> 0),
+                             attachments = attachments - (coalesce(old.has_attachments, 0) > 0)
+           WHERE category_id = old.category;
+         DELETE FROM Category WHERE category_id = old.category AND messages <= 0;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS CategoryUpdate AFTER UPDATE OF category, is_unread, has_attachments ON Message BEGIN
+         UPDATE Category SET messages    = messages - 1,
+                             unread      = unread - (coalesce(old.is_unread, 0) <> 0),
+                             attachments = attachments - (coalesce(old.has_attachments, 0) > 0)
+           WHERE category_id = old.category;
+         DELETE FROM Category WHERE category_id = old.category AND messages <= 0;
+         INSERT OR IGNORE INTO Category (category_id, messages, unread, attachments) VALUES (new.category, 0, 0, 0);
+         UPDATE Category SET messages    = messages + 1,
+                             unread      = unread + (coalesce(new.is_unread, 0) <> 0),
+                             attachments = attachments + (coalesce(new.has_attachments, 0) > 0)
+           WHERE category_id = new.category;
+       END"""
+]
+
+# Attachments reference their data in Blob by hash, the triggers keep the
+# reference count of every blob and drop the ones no longer referenced.
+blobTriggerQueries = [
+    """CREATE TRIGGER IF NOT EXISTS BlobReference AFTER INSERT ON Attachment
+         WHEN new.data_hash IS NOT NULL AND new.data_hash <> '' BEGIN
+         UPDATE Blob SET refcount = refcount + 1 WHERE blob_id = new.data_hash;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS BlobRelease AFTER DELETE ON Attachment
+         WHEN old.data_hash IS NOT NULL AND old.data_hash <> '' BEGIN
+         UPDATE Blob SET refcount = refcount - 1 WHERE blob_id = old.data_hash;
+         DELETE FROM Blob WHERE blob_id = old.data_hash AND refcount <= 0;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS BlobUpdate AFTER UPDATE OF data_hash ON Attachment BEGIN
+         UPDATE Blob SET refcount = refcount - 1 WHERE blob_id = old.data_hash;
+         DELETE FROM Blob WHERE blob_id = old.data_hash AND refcount <= 0;
+         UPDATE Blob SET refcount = refcount + 1 WHERE blob_id = new.data_hash;
+       END"""
+]
+
+class BatchWriter():
+    def __init__(self, database, batchSize = 1000, pragmas = None, onFlush = None):
+        self.database  = database
+        self.batchSize = batchSize
+        self.pragmas   = importPragmas if pragmas is None else pragmas
+        self.onFlush   = onFlush
+        self.previous  = {}
+        self.pending   = []
+
+    def __enter__(self):
+        connection = self.database.connection
+        connection.commit()
+
+        for pragma, value in self.pragmas.items():
+            self.previous[pragma] = connection.execute('PRAGMA %s' % pragma).fetchone()[0]
+            connection.execute('PRAGMA %s = %s' % (pragma, value))
+
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.flush()
+
+        connection = self.database.connection
+
+        # The journal mode is kept, WAL also lets readers work during imports
+        for pragma, value in self.previous.items():
+            if pragma != 'journal_mode':
+                connection.execute('PRAGMA %s = %s' % (pragma, value))
+
+        return False
+
+    def add(self, entry):
+        self.pending.append(entry)
+
+        if len(self.pending) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            with timed('db.insert'):
+                inserted = self.database.insertMany(self.pending)
+
+            # Called once the batch is committed, with the rows written per table
+            if self.onFlush is not None:
+                self.onFlush(self.pending, inserted)
+
+            self.pending = []
+
+class MessageListCache():
+    # Windowed row cache over Database.getMessagePage, giving random access by
+    # row index to a listing while only keeping a few pages in memory.
+    def __init__(self, database, pageSize = 200, maxPages = 16):
+        self.database = database
+        self.pageSize = pageSize
+        self.maxPages = maxPages
+        self.reset(database)
+
+    def reset(self, database, filters = {}, orderBy = 'date', descending = True):
+        self.database   = database
+        self.filters    = dict(filters)
+        self.orderBy    = orderBy
+        self.descending = descending
+        self.pages      = collections.OrderedDict()
+        # Start token of the pages, learned while reading the previous ones
+        self.tokens     = {0: None}
+        self.count      = database.countMessages(**self.filters)
+
+        return self.count
+
+    def getRow(self, index):
+        rows   = self._getPage(index // self.pageSize)
+        offset = index % self.pageSize
+
+        return rows[offset] if offset < len(rows) else None
+
+    def _getPage(self, page):
+        if page in self.pages:
+            self.pages.move_to_end(page)
+            return self.pages[page]
+
+        if page in self.tokens:
+            rows, token = self.database.getMessagePage(
+                pageSize = self.pageSize, token = self.tokens[page],
+                orderBy = self.orderBy, descending = self.descending, **self.filters)
+        else:
+            rows, token = self.database.getMessagePage(
+                pageSize = self.pageSize, offset = page * self.pageSize,
+                orderBy = self.orderBy, descending = self.descending, **self.filters)
+
+        if token is not None:
+            self.tokens[page + 1] = token
+
+        self.pages[page] = rows
+
+        if len(self.pages) > self.maxPages:
+            self.pages.popitem(last = False)
+
+        return rows
+
+class MessageViewCache():
+    # LRU cache of the decoded bodies and attachment names of the viewed
+    # messages, bounded by the size of the text it keeps.
+    def __init__(self, database, maxBytes = 32 << 20):
+        self.maxBytes = maxBytes
+        self.reset(database)
+
+    def reset(self, database):
+        self.database = database
+        self.views    = collections.OrderedDict()
+        self.size     = 0
+
+    def get(self, message_id):
+        if message_id in self.views:
+            self.views.move_to_end(message_id)
+            return self.views[message_id]
+
+        self._store(message_id, self.database.getMessageViews([message_id]).get(message_id, ('', '', [])))
+        return self.views[message_id]
+
+    def prefetch(self, message_ids):
+        # Reads the messages which aren't cached yet with a single query,
+        # without making them more recent than the viewed one.
+        missing = [message_id for message_id in message_ids if message_id not in self.views]
+
+        for message_id, view in self.database.getMessageViews(missing).items():
+            self._store(message_id, view, False)
+
+    def _store(self, message_id, view, recent = True):
+        self.views[message_id] = view
+        if not recent:
+            self.views.move_to_end(message_id, last = False)
+        self.size += self._getSize(view)
+
+        while self.size > self.maxBytes and len(self.views) > 1:
+            evicted = self.views.popitem(last = False)[1]
+            self.size -= self._getSize(evicted)
+
+    def _getSize(self, view):
+        html, plain, attachments = view
+        return len(html or '') + len(plain or '') + sum(len(name) for name in attachments)
 
 class Database():
-    def __init__(self, database = ':memory:'):
+    def __init__(self, database = ':memory:', codec = None):
+        self.filename   = database
         self.connection = sqlite3.connect(database)
         self.insertQueries = {}
+        self.insertValues  = {}
+
+        # The triggers need the bodies as text
+        self.connection.create_function('unpackBody', 1, unpackBody, deterministic = True)
+        self.connection.create_function('packBody', 1, lambda text: packBody(text, self.codec))
+        self.connection.create_function('uniqueAddresses', 2, uniqueAddresses, deterministic = True)
+
+        # Print the query plan of every query issued, to spot missing indexes
+        self.explainQueries = False
 
         with self.connection:
+            addedColumns = set()
 
             for table in databaseTables:
-                constructor = globals()[table]
-                instance = constructor()
+                instance = globals()[table]()
+                query, attributes = self._createTableQuery(table)
 
-                primaryKeys = []
-                attributes  = []
+                self.connection.execute(query)
 
-                for attribute, value in instance.__dict__.items():
-                    # We'll set the attribute by default as text
-                    attributeType = 'TEXT'
+                # Databases created by older versions may miss some columns
+                existing = [row[1] for row in self.connection.execute('PRAGMA table_info(%s)' % table)]
+                for attribute in attributes:
+                    if attribute.split(' ')[0] not in existing:
+                        self.connection.execute('ALTER TABLE %s ADD COLUMN %s' % (table, attribute))
+                        addedColumns.add((table, attribute.split(' ')[0]))
 
-                    if attribute.endswith('_id'):
-                        primaryKeys.append(attribute)
+                # Prepare insert query
+                placeholders = ', '.join(['?'] * len(instance.__dict__))
+                columns      = ', '.join(instance.__dict__.keys())
+                conflict     = 'REPLACE' if table in databaseReplaceTables else 'IGNORE'
+                query = 'INSERT OR %s INTO %s (%s) VALUES (%s)' % (conflict, table, columns, placeholders)
+                self.insertQueries[table] = query
+                self.insertValues[table]  = operator.attrgetter(*instance.__dict__.keys())
+
+                if table in bodyColumns:
+                    self.insertValues[table] = self._packedValues(table, self.insertValues[table])
 
-                    if attribute in databaseAttrTypes.keys():
-                        attributeType = databaseAttrTypes[attribute]
+            self._migrateBodies()
+            self._migrateTimestamps(addedColumns)
 
-                    attributes.append('%s %s' % (attribute, attributeType))
+            # The codec of the new bodies is a setting of the database
+            self.codec = self.getSetting('body_codec', 'none')
 
-                query = 'CREATE TABLE IF NOT EXISTS %s(\n\t' % table
-                query = query + ',\n\t'.join(attributes)
+            if codec is not None and codec != self.codec:
+                self.setSetting('body_codec', codec)
+                self.codec = codec
 
-                if len(primaryKeys) > 0:
-                    query = query + ', PRIMARY KEY (%s)\n' % ', '.join(primaryKeys)
+            self._createSearchTable()
 
-                query =  query + ')'
+            # Triggers are recreated, in case their definition changed
+            triggers = blobTriggerQueries + conversationTriggerQueries + categoryTriggerQueries + \
+                       (searchTriggerQueries(self.searchDeletes) if self.hasSearch else [])
 
+            for query in triggers:
+                words = query.split()
+                name  = words[words.index('EXISTS') + 1]
+                # Also drops the permanent search triggers of older versions
+                self.connection.execute('DROP TRIGGER IF EXISTS main.%s' % name)
                 self.connection.execute(query)
 
-                # Prepare insert query
-                placeholders = ', '.join(['?'] * len(instance.__dict__))
-                columns      = ', '.join(instance.__dict__.keys())
-                query = 'INSERT INTO %s (%s) VALUES (%s)' % (table, columns, placeholders)
-                self.insertQueries[table] = query
+        # New databases get their indexes after the first import, existing
+        # ones may predate them, and their category counts.
+        if self.connection.execute('SELECT 1 FROM Message LIMIT 1').fetchone():
+            self.createIndexes()
+
+            if not self.connection.execute('SELECT 1 FROM Category LIMIT 1').fetchone():
+                self.rebuildCategories()
+
+            if not self.connection.execute('SELECT 1 FROM MessageAddress LIMIT 1').fetchone():
+                self.rebuildAddresses()
+
 
     def __del__(self):
         self.connection.commit()
         self.connection.close()
 
+    def _packedValues(self, table, values):
+        # Compresses the body columns of the rows, with the codec of the database
+        positions = [list(globals()[table]().__dict__).index(column) for column in bodyColumns[table]]
+
+        def packedValues(entry):
+            row = list(values(entry))
+            for position in positions:
+                row[position] = packBody(row[position], self.codec)
+            return row
+
+        return packedValues
+
+    def getSetting(self, name, default = None):
+        for row in self.connection.execute('SELECT value FROM Setting where setting_id = ?', (name,)):
+            return row[0]
+
+        return default
+
+    def setSetting(self, name, value):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO Setting (setting_id, value) VALUES (?, ?)', (name, value))
+
+    def recompressBodies(self, codec, batchSize = 1000):
+        # Stores all the bodies with the codec, new ones included, and returns
+        # the size of the database file before and after.
+        if codec != 'none' and codec not in bodyCodecs:
+            raise ValueError('Unknown body codec: ' + codec)
+
+        before = self.getDatabaseSize()
+
+        self.setSetting('body_codec', codec)
+        self.codec = codec
+
+        for table, columns in bodyColumns.items():
+            select = 'SELECT rowid, %s FROM %s where rowid > ? ORDER BY rowid LIMIT ?' % (', '.join(columns), table)
+            update = 'UPDATE %s SET %s where rowid = ?' % (table, ', '.join(column + ' = ?' for column in columns))
+            lastRowId = -1
+
+            while True:
+                rows = self.connection.execute(select, (lastRowId, batchSize)).fetchall()
+                if not rows:
+                    break
+
+                with self.connection:
+                    self.connection.executemany(update, (
+                        [packBody(unpackBody(value), codec) for value in row[1:]] + [row[0]] for row in rows))
+
+                lastRowId = rows[-1][0]
+
+        # Hand the freed pages back to the file system
+        self.connection.execute('VACUUM')
+
+        return (before, self.getDatabaseSize())
+
+    def getDatabaseSize(self):
+        pageCount = self.connection.execute('PRAGMA page_count').fetchone()[0]
+        pageSize  = self.connection.execute('PRAGMA page_size').fetchone()[0]
+        return pageCount * pageSize
+
+    def _createTableQuery(self, table, name = None):
+        constructor = globals()[table]
+        instance = constructor()
+
+        primaryKeys = []
+        attributes  = []
+
+        for attribute, value in instance.__dict__.items():
+            # We'll set the attribute by default as text
+            attributeType = 'TEXT'
+
+            if attribute.endswith('_id'):
+                primaryKeys.append(attribute)
+
+            if attribute in databaseAttrTypes.keys():
+                attributeType = databaseAttrTypes[attribute]
+
+            attributes.append('%s %s' % (attribute, attributeType))
+
+        primaryKeys = databasePrimaryKeys.get(table, primaryKeys)
+
+        query = 'CREATE TABLE IF NOT EXISTS %s(\n\t' % (name or table)
+        query = query + ',\n\t'.join(attributes)
+
+        if len(primaryKeys) > 0:
+            query = query + ', PRIMARY KEY (%s)\n' % ', '.join(primaryKeys)
+
+        query =  query + ')'
+
+        return (query, attributes)
+
+    def _migrateBodies(self):
+        # Older databases keep the bodies in Message, along the columns read
+        # by every listing. They are moved to Content and Message is rebuilt
+        # without them, keeping the rowids the search index refers to.
+        existing = [row[1] for row in self.connection.execute('PRAGMA table_info(Message)')]
+        if 'content' not in existing:
+            return
+
+        for table in ['Messages', 'Conversations']:
+            self.connection.execute('DROP TABLE IF EXISTS %s' % table)
+            self.connection.execute(self._createTableQuery(table)[0])
+
+        self.connection.execute(
+            'INSERT OR IGNORE INTO Content (message_id, content, rich_content) \
+               SELECT message_id, content, rich_content FROM Message')
+
+        columns = ', '.join(Message().__dict__.keys())
+        self.connection.execute(self._createTableQuery('Message', 'MessageMigration')[0])
+        self.connection.execute(
+            'INSERT INTO MessageMigration (rowid, %s) SELECT rowid, %s FROM Message' % (columns, columns))
+        self.connection.execute('DROP TABLE Message')
+        self.connection.execute('ALTER TABLE MessageMigration RENAME TO Message')
+
+    def _createSearchTable(self):
+        # Not every sqlite build comes with fts5, searches fall back to
+        # plain LIKE filters without it.
+        self.hasSearch     = False
+        self.searchDeletes = False
+        self.searchReady   = False
+
+        existing = self.connection.execute("SELECT sql FROM sqlite_master WHERE name = 'MessageSearch'").fetchone()
+
+        # Older versions kept a full copy of the text in the index
+        if existing is not None and "content=''" not in existing[0]:
+            self.connection.execute('DROP TABLE MessageSearch')
+            existing = None
+
+        if existing is None:
+            for query in searchTableQueries:
+                try:
+                    self.connection.execute(query)
+                    existing = (query,)
+                    break
+                except sqlite3.OperationalError:
+                    pass
+            else:
+                return
+
+            # The messages already there are indexed by rebuildSearchIndex
+            empty = self.connection.execute('SELECT 1 FROM Message LIMIT 1').fetchone() is None
+            self.setSetting('search_index', 'complete' if empty else 'missing')
+
+        self.hasSearch     = True
+        self.searchDeletes = 'contentless_delete' in existing[0]
+        self.checkSearchIndex()
+
+    def checkSearchIndex(self):
+        # Searches only use the index once it holds every message, until then
+        # they fall back to LIKE filters. Only the last rowids are compared,
+        # enough to notice messages added by other sqlite clients.
+        lastRowId = 'SELECT rowid FROM %s ORDER BY rowid DESC LIMIT 1'
+
+        self.searchReady = self.hasSearch and self.getSetting('search_index') == 'complete' and \
+                           (self.connection.execute(lastRowId % 'MessageSearch').fetchone() or (0,))[0] >= \
+                           (self.connection.execute(lastRowId % 'Message').fetchone() or (0,))[0]
+
+        return self.searchReady
+
+    def _migrateTimestamps(self, addedColumns):
+        # Older databases only have the date strings, which are in the time
+        # zone of every message. Reading them as UTC is off by that offset at
+        # most, close enough for ordering and ranges until a reimport.
+        for table in ['Message', 'Conversation']:
+            if (table, 'timestamp') in addedColumns:
+                self.connection.execute(
+                    "UPDATE %s SET timestamp = CAST(strftime('%%s', date) AS INTEGER)" % table)
+
+        # The listings used to be ordered by the date strings
+        if ('Message', 'timestamp') in addedColumns:
+            for index in ['MessageDate', 'MessageCategoryDate']:
+                self.connection.execute('DROP INDEX IF EXISTS %s' % index)
+
+    def _execute(self, query, parameters = ()):
+        if self.explainQueries:
+            self.printQueryPlan(query, parameters)
+
+        return self.connection.execute(query, parameters)
+
+    def queryPlan(self, query, parameters = ()):
+        # Own cursor, the callers may have a row_factory set on the connection
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        return cursor.execute('EXPLAIN QUERY PLAN ' + query, parameters).fetchall()
+
+    def printQueryPlan(self, query, parameters = ()):
+        print(' '.join(query.split()))
+
+        depth = {0: 0}
+        for id, parent, notused, detail in self.queryPlan(query, parameters):
+            depth[id] = depth.get(parent, 0) + 1
+            print('  ' * depth[id] + detail)
+
+    def createIndexes(self):
+        with timed('db.createIndexes'), self.connection:
+            for index, (table, columns) in databaseIndexes.items():
+                self.connection.execute(
+                    'CREATE INDEX IF NOT EXISTS %s ON %s(%s)' % (index, table, ', '.join(columns)))
+
+            self.connection.execute('PRAGMA optimize')
+
+    def dropIndexes(self):
+        with self.connection:
+            for index in databaseIndexes:
+                self.connection.execute('DROP INDEX IF EXISTS %s' % index)
+
     def saveToFile(self, filename):
         targetDB = sqlite3.connect(filename)
 
@@ -58,46 +656,479 @@ class Database():
         targetDB.close()
 
     def insert(self, data):
-        table        = type(data).__name__
-        self.connection.execute(self.insertQueries[table], list(vars(data).values()))
+        table = type(data).__name__
+
+        if table != 'Attachment':
+            return self.connection.execute(self.insertQueries[table], self.insertValues[table](data)).rowcount
+
+        values, blobs = self._storeBlobs([data])
+
+        try:
+            return self.connection.execute(self.insertQueries[table], values[0]).rowcount
+        finally:
+            self._releaseBlobs(blobs)
+
+    def _storeBlobs(self, attachments):
+        # Moves the data of the attachments to the blob store and returns the
+        # rows to insert, which keep the hash only, with the keys of the blobs.
+        # The attachments themselves are left as they are, they may still be
+        # inserted elsewhere. Blobs start unreferenced, the insert trigger of
+        # the attachment counts the reference.
+        columns = list(Attachment().__dict__)
+        data, dataHash = columns.index('data'), columns.index('data_hash')
+
+        blobs  = {}
+        values = []
+
+        for attachment in attachments:
+            row = list(self.insertValues['Attachment'](attachment))
+
+            if row[data] is not None:
+                if not isinstance(row[data], bytes):
+                    row[data] = str(row[data]).encode('utf-8')
+
+                if not row[dataHash]:
+                    row[dataHash] = getContentHash(row[data])
+
+                blobs[row[dataHash]] = row[data]
+                row[data] = None
+
+            values.append(row)
+
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO Blob (blob_id, size, refcount, data) VALUES (?, ?, 0, ?)',
+            ((key, len(blob), blob) for key, blob in blobs.items()))
+
+        return values, list(blobs)
+
+    def _releaseBlobs(self, keys):
+        # Drops the blobs stored for attachments which could not be inserted
+        self.connection.executemany(
+            'DELETE FROM Blob WHERE blob_id = ? AND refcount <= 0', ((key,) for key in keys))
+
+    def insertMany(self, entries):
+        # Group the rows per table, so each table is written with a single
+        # executemany, and write the whole batch in one transaction.
+        # Returns the rows written per table, without the ones ignored as
+        # already present.
+        rows     = {}
+        inserted = {}
+
+        for entry in entries:
+            rows.setdefault(type(entry).__name__, []).append(entry)
+
+        if not self.connection.in_transaction:
+            self.connection.execute('BEGIN')
+
+        for table in databaseTables:
+            if table not in rows:
+                continue
+
+            # Outside of the savepoint, the blobs are kept for a row by row retry
+            if table == 'Attachment':
+                values, blobs = self._storeBlobs(rows[table])
+            else:
+                values = list(map(self.insertValues[table], rows[table]))
+
+            self.connection.execute('SAVEPOINT batch')
+
+            try:
+                inserted[table] = self.connection.executemany(self.insertQueries[table], values).rowcount
+            except sqlite3.Error:
+                # Redo the table row by row to keep all but the faulty entries
+                self.connection.execute('ROLLBACK TO batch')
+                inserted[table] = 0
+
+                for entry, row in zip(rows[table], values):
+                    try:
+                        inserted[table] += self.connection.execute(self.insertQueries[table], row).rowcount
+                    except Exception as err:
+                        print("Back to the drawing board: {0} for {1}".format(err, entry))
+
+            self.connection.execute('RELEASE batch')
+
+            if table == 'Attachment':
+                self._releaseBlobs(blobs)
+
+        self.connection.commit()
+        return inserted
+
+    def batchWriter(self, batchSize = 1000, pragmas = None, onFlush = None):
+        return BatchWriter(self, batchSize, pragmas, onFlush)
+
+    def insertStream(self, entries, batchSize = 1000, pragmas = None, onFlush = None):
+        # Consume the entries as they are produced, writing them batchSize
+        # rows at a time, so neither the caller nor the transaction grows unbounded.
+        with self.batchWriter(batchSize, pragmas, onFlush) as writer:
+            for entry in entries:
+                writer.add(entry)
+
+    def getAttachmentStatistics(self):
+        # Bytes of attachment data as imported and as actually stored
+        stored, referenced = self._execute(
+            'SELECT coalesce(sum(size), 0), coalesce(sum(size * refcount), 0) FROM Blob').fetchone()
+        inline = self._execute(
+            'SELECT coalesce(sum(length(data)), 0) FROM Attachment where data IS NOT NULL').fetchone()[0]
+
+        return {
+            'attachmentBytes' : referenced + inline,
+            'storedBytes'     : stored + inline,
+            'savedBytes'      : referenced - stored,
+            'inlineBytes'     : inline
+        }
+
+    def migrateAttachmentBlobs(self, batchSize = 1000):
+        # Moves the data still stored inline in Attachment to the blob store
+        query = 'SELECT rowid, data FROM Attachment where data IS NOT NULL limit ?'
+        moved = 0
+
+        while True:
+            rows = self.connection.execute(query, (batchSize,)).fetchall()
+            if not rows:
+                break
+
+            blobs = []
+            for rowid, data in rows:
+                data = data if isinstance(data, bytes) else str(data).encode('utf-8')
+                blobs.append((getContentHash(data), rowid, data))
+
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT OR IGNORE INTO Blob (blob_id, size, refcount, data) VALUES (?, ?, 0, ?)',
+                    ((key, len(data), data) for key, rowid, data in blobs))
+                self.connection.executemany(
+                    'UPDATE Attachment SET data_hash = ?, data = NULL where rowid = ?',
+                    ((key, rowid) for key, rowid, data in blobs))
+
+            moved += len(rows)
+
+        return moved
+
+    def remapMessageIds(self, mapping):
+        # Renames message ids given as (old, new) pairs. A message whose new id
+        # is already taken is a duplicate of that message, so it is dropped.
+        with self.connection:
+            self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS MessageIdMap(old_id BIGINT PRIMARY KEY, new_id BIGINT)')
+            self.connection.execute('DELETE FROM MessageIdMap')
+            self.connection.executemany('INSERT OR REPLACE INTO MessageIdMap VALUES (?, ?)', mapping)
+            self.connection.execute('DELETE FROM MessageIdMap where old_id = new_id')
+
+            # The bodies move first, the search index reads them under the new
+            # id when the messages are updated
+            for table in ['Content', 'Message', 'Attachment', 'MessageSource', 'MessageAddress']:
+                self.connection.execute(
+                    'UPDATE OR IGNORE %s SET message_id = \
+                       (SELECT new_id FROM MessageIdMap WHERE old_id = message_id) \
+                     where message_id IN (SELECT old_id FROM MessageIdMap)' % table)
+                self.connection.execute(
+                    'DELETE FROM %s where message_id IN (SELECT old_id FROM MessageIdMap)' % table)
+
+            self.connection.execute('DELETE FROM MessageIdMap')
 
     def cleanTable(self, tableName):
         query = 'DELETE FROM %s' % (tableName)
         self.connection.execute(query)
 
-    def getMessages(self, category = "", recipients = "", sender = "", subject = "", content = ""):
-        parameters = locals()
-        query = 'SELECT message_id, sender, recipients, subject, date, has_attachments FROM Message '
-        #query = 'SELECT * FROM Message '
-        queryFilter = ''
+    def getMessages(self, category = "", recipients = "", sender = "", subject = "", content = "", ranked = False,
+                    since = None, until = None):
+        filters = locals()
+        query, queryFilter, parameters, match = self._messageFilter(filters)
+
+        query = 'SELECT Message.message_id, Message.sender, Message.recipients, Message.subject, \
+                        Message.date, Message.has_attachments FROM ' + query
+        query += '' if (not queryFilter) else (' where ' + ' and '.join(queryFilter))
+        query += ' order by MessageSearch.rank' if (match and ranked) else \
+                 ' order by Message.timestamp DESC, Message.message_id DESC'
+
+        return self._execute(query, parameters)
+
+    def getMessagePage(self, category = "", recipients = "", sender = "", subject = "", content = "",
+                       pageSize = 200, token = None, orderBy = 'date', descending = True, offset = 0,
+                       since = None, until = None):
+        # Keyset pagination: the rows are ordered by (orderBy, message_id) and
+        # the next page seeks right after the last row of the previous one, so
+        # every page costs the same whatever its position in the list.
+        # Returns the rows and the token of the next page, None on the last one.
+        # The offset is only meant for jumps to pages without a known token.
+        filters = locals()
+        sortKey = sortColumns.get(orderBy, orderBy)
+        # The sort key is read last, for the token, and left out of the rows
+        columns = ', '.join('Message.' + name for name in listColumns + [sortKey])
+        order   = ' DESC' if descending else ' ASC'
+        limit   = offset + pageSize + 1
+        seeks   = self._seekFilters(sortKey, token, descending)
+
+        categories = self.getSubCategories(category) if category else []
+        scopes     = [([], [])]
+
+        if 0 < len(categories) <= maxCategoryBranches and not self._matchQuery(filters):
+            # Several categories can't be read from the index in order at
+            # once, so read a page from each of them and merge these instead
+            # of sorting everything below the selected category.
+            filters['category'] = ''
+            scopes = [(['category = ?'], [name]) for name in categories]
+
+        query, queryFilter, parameters, match = self._messageFilter(filters)
+
+        if len(scopes) == 1 and len(seeks) == 1:
+            queryFilter = queryFilter + scopes[0][0] + seeks[0][0]
+            parameters  = parameters + scopes[0][1] + seeks[0][1]
+
+            query = 'SELECT ' + columns + ' FROM ' + query
+            query += '' if (not queryFilter) else (' where ' + ' and '.join(queryFilter))
+            query += ' order by Message.' + sortKey + order + ', Message.message_id' + order
+        else:
+            # Every category and key range is read in order from the index,
+            # only their first rows are merged
+            branches = []
+            branchParameters = []
+
+            for scopeFilter, scopeParameters in scopes:
+                for seekFilter, seekParameters in seeks:
+                    branchFilter = queryFilter + scopeFilter + seekFilter
+                    branches.append('SELECT * FROM (SELECT ' + columns + ' FROM ' + query +
+                                    ('' if (not branchFilter) else (' where ' + ' and '.join(branchFilter))) +
+                                    ' order by Message.' + sortKey + order + ', Message.message_id' + order +
+                                    ' limit ?)')
+                    branchParameters.extend(parameters + scopeParameters + seekParameters + [limit])
+
+            query = ' UNION ALL '.join(branches)
+            query += ' order by %d%s, 1%s' % (len(listColumns) + 1, order, order)
+            parameters = branchParameters
+
+        query += ' limit ? offset ?'
+        parameters.extend([pageSize + 1, offset])
+
+        rows = self._execute(query, parameters).fetchall()
+
+        token = (rows[pageSize - 1][-1], rows[pageSize - 1][0]) if len(rows) > pageSize else None
+        return ([row[:-1] for row in rows[:pageSize]], token)
+
+    def _seekFilters(self, sortKey, token, descending):
+        # Filters of the rows after the token, as (filter, parameters) pairs
+        # each read as one range of the index. NULL keys, e.g. messages
+        # without a date, sort first and don't compare with row values, so
+        # they get a range of their own.
+        if token is None:
+            return [([], [])]
+
+        value, message_id = token
+        after = '<' if descending else '>'
+
+        if value is None:
+            seeks = [(['Message.%s IS NULL' % sortKey, 'Message.message_id %s ?' % after], [message_id])]
+            return seeks if descending else seeks + [(['Message.%s IS NOT NULL' % sortKey], [])]
+
+        seeks = [(['(Message.%s, Message.message_id) %s (?, ?)' % (sortKey, after)], [value, message_id])]
+        return seeks + [(['Message.%s IS NULL' % sortKey], [])] if descending else seeks
+
+    def getSubCategories(self, category):
+        # The category itself and all the categories below it
+        query = 'SELECT distinct(category) FROM Message where category = ? or (category > ? and category < ?)'
+
+        self.connection.row_factory = lambda cursor, row: row[0]
+        categories = self._execute(query, (category, category + '/', category + '0')).fetchall()
+        self.connection.row_factory = None
+        return categories
+
+    def countMessages(self, category = "", recipients = "", sender = "", subject = "", content = "", limit = None,
+                      since = None, until = None):
+        # With a limit, counting stops there and the result reads as
+        # "limit or more", which is enough to size a list or show a total.
+        filters = locals()
+        query, queryFilter, parameters, match = self._messageFilter(filters)
+
+        query = 'SELECT 1 FROM ' + query
+        query += '' if (not queryFilter) else (' where ' + ' and '.join(queryFilter))
+
+        if limit is not None:
+            query += ' limit ?'
+            parameters.append(limit)
+
+        return self._execute('SELECT count(*) FROM (' + query + ')', parameters).fetchone()[0]
+
+    def _messageFilter(self, filters):
+        query = 'Message '
+        queryFilter = []
+        parameters  = []
+
+        category = filters['category']
+        if category:
+            # The category itself and all its sub categories
+            queryFilter.append('(category = ? or (category > ? and category < ?))')
+            parameters.extend([category, category + '/', category + '0'])
+
+        # UTC epoch seconds, since included and until excluded
+        if filters.get('since') is not None:
+            queryFilter.append('Message.timestamp >= ?')
+            parameters.append(int(filters['since']))
+
+        if filters.get('until') is not None:
+            queryFilter.append('Message.timestamp < ?')
+            parameters.append(int(filters['until']))
+
+        # Whole addresses are looked up in the address index
+        filters = dict(filters)
+
+        for column, role in addressColumns.items():
+            value = filters[column]
+            if value and isinstance(value, str) and emailPattern.fullmatch(value.strip()):
+                queryFilter.append('Message.message_id IN \
+                    (SELECT message_id FROM MessageAddress where address_id = ? and role = ?)')
+                parameters.extend([getAddressId(value.strip()), role])
+                filters[column] = ''
+
+        match = self._matchQuery(filters)
+
+        if match:
+            query += 'JOIN MessageSearch ON MessageSearch.rowid = Message.rowid '
+            queryFilter.append('MessageSearch MATCH ?')
+            parameters.append(match)
+        elif not self.searchReady:
+            for column in searchColumns:
+                value = filters[column]
+                if value and isinstance(value, str):
+                    if column == 'content':
+                        queryFilter.append('Message.message_id IN (SELECT message_id FROM Content where unpackBody(content) like ?)')
+                    else:
+                        queryFilter.append('Message.' + column + ' like ?')
+                    parameters.append('%' + value + '%')
+
+        return (query, queryFilter, parameters, match)
+
+    def _matchQuery(self, filters):
+        # Each text filter becomes a prefix phrase restricted to its column,
+        # e.g. subject : "quarterly rep"*
+        terms = []
+
+        if self.searchReady:
+            for column in searchColumns:
+                value = filters[column]
+                if value and isinstance(value, str):
+                    terms.append('%s : "%s"*' % (column, value.replace('"', '""')))
+
+        return ' AND '.join(terms)
+
+    def rebuildSearchIndex(self, batchSize = 10000, full = False):
+        # Index the messages missing from the search index, batchSize rows per
+        # transaction. As it only looks at what is missing, it can be stopped
+        # and resumed at any time on large databases. Searches use the index
+        # once it is complete.
+        if not self.hasSearch:
+            return 0
+
+        # Rows of messages deleted by other clients can only be removed one
+        # by one with contentless_delete, otherwise everything is indexed again
+        orphans = self.connection.execute(
+            'SELECT 1 FROM MessageSearch WHERE rowid NOT IN (SELECT rowid FROM Message) LIMIT 1').fetchone()
+
+        with self.connection:
+            if full or (orphans and not self.searchDeletes):
+                self.connection.execute("INSERT INTO MessageSearch(MessageSearch) VALUES ('delete-all')")
+            elif orphans:
+                self.connection.execute('DELETE FROM MessageSearch WHERE rowid NOT IN (SELECT rowid FROM Message)')
+
+        query = 'INSERT INTO MessageSearch(rowid, %s) \
+                   SELECT Message.rowid, Message.subject, Message.sender, Message.recipients, \
+                          coalesce(unpackBody(Content.content), \'\') FROM Message \
+                     LEFT JOIN Content ON Content.message_id = Message.message_id \
+                     WHERE Message.rowid > ? AND Message.rowid <= ? AND \
+                       NOT EXISTS (SELECT 1 FROM MessageSearch WHERE MessageSearch.rowid = Message.rowid)' % ', '.join(searchColumns)
+        endQuery = 'SELECT max(rowid) FROM (SELECT rowid FROM Message WHERE rowid > ? ORDER BY rowid LIMIT ?)'
+
+        indexed = 0
+        lastRowId = -1
+
+        while True:
+            end = self.connection.execute(endQuery, (lastRowId, batchSize)).fetchone()[0]
+            if end is None:
+                break
+
+            with self.connection:
+                indexed += self.connection.execute(query, (lastRowId, end)).rowcount
 
-        for parameter in parameters:
-            value = parameters[parameter]
-            if value and isinstance(value, str):
-                queryFilter += '' if (not queryFilter) else ' and '
-                queryFilter += parameter + " like '%" + value + "%'"
+            lastRowId = end
 
-        query += '' if (not queryFilter) else (' where ' + queryFilter)
-        query +=' order by date DESC'
+        self.setSetting('search_index', 'complete')
+        self.checkSearchIndex()
 
-        return self.connection.execute(query)
+        return indexed
 
     def getContent(self, message_id):
-        parameters = locals()
-        query = 'SELECT rich_content, content FROM Message'
-        query += ' where message_id = ' + str(message_id)
+        query = 'SELECT rich_content, content FROM Content where message_id = ?'
 
-        for row in self.connection.execute(query):
-            return (row[0], row[1])
+        for row in self._execute(query, (message_id,)):
+            return (unpackBody(row[0]), unpackBody(row[1]))
 
         return ('', '')
 
+    def rebuildCategories(self):
+        with self.connection:
+            self.cleanTable('Category')
+            self._execute(
+                'INSERT INTO Category (category_id, messages, unread, attachments) \
+                   SELECT category, count(*), sum(coalesce(is_unread, 0) <> 0), sum(coalesce(has_attachments, 0) > 0) \
+                     FROM Message group by category')
+
+        return self.connection.execute('SELECT count(*) FROM Category').fetchone()[0]
+
+    def rebuildAddresses(self, batchSize = 10000):
+        # Links the messages to the addresses of their sender and recipients
+        # columns, for databases imported before the Address table. The cc
+        # addresses were not kept by then.
+        lastRowId = -1
+        linked    = 0
+
+        while True:
+            rows = self.connection.execute(
+                'SELECT rowid, message_id, sender, recipients FROM Message where rowid > ? and is_conversation = 0 \
+                   ORDER BY rowid LIMIT ?', (lastRowId, batchSize)).fetchall()
+            if not rows:
+                break
+
+            entries = []
+            for rowid, message_id, sender, recipients in rows:
+                entries.extend(getAddressEntries(message_id, [
+                    ('from', [address for address in (sender or '').split(',') if address]),
+                    ('to',   [address for address in (recipients or '').split(',') if address])]))
+
+            self.insertMany(entries)
+            linked   += len(entries) // 2
+            lastRowId = rows[-1][0]
+
+        return linked
+
+    def getCorrespondents(self, role = None, limit = None):
+        # (address, messages) of the addresses by number of messages, of one
+        # role or all of them
+        query = 'SELECT Address.address, count(distinct(MessageAddress.message_id)) AS messages FROM MessageAddress \
+                   JOIN Message ON Message.message_id = MessageAddress.message_id \
+                   JOIN Address ON Address.address_id = MessageAddress.address_id'
+        parameters = []
+
+        if role is not None:
+            query += ' where MessageAddress.role = ?'
+            parameters.append(role)
+
+        query += ' group by MessageAddress.address_id order by messages DESC'
+
+        if limit is not None:
+            query += ' limit ?'
+            parameters.append(limit)
+
+        return self._execute(query, parameters).fetchall()
+
+    def getCategoryCounts(self):
+        # (category, messages, unread, attachments) of every category
+        query = 'SELECT category_id, messages, unread, attachments FROM Category order by category_id'
+
+        return self._execute(query).fetchall()
+
     def getCategories(self):
-        query = 'SELECT distinct(category) FROM Message'
+        query = 'SELECT category_id FROM Category'
 
         self.connection.row_factory = lambda cursor, row: row[0]
-        cursor = self.connection.cursor()
-        categories = cursor.execute(query).fetchall()
+        categories = self._execute(query).fetchall()
         self.connection.row_factory = None
         return categories
 
@@ -105,8 +1136,7 @@ class Database():
         query = 'SELECT thread_id, conversation_id FROM Conversation'
 
         self.connection.row_factory = lambda cursor, row: (row[0], row[1])
-        cursor = self.connection.cursor()
-        categories = cursor.execute(query).fetchall()
+        categories = self._execute(query).fetchall()
         self.connection.row_factory = None
         return categories
 
@@ -114,78 +1144,286 @@ class Database():
         query = 'SELECT message_id FROM Message'
 
         self.connection.row_factory = lambda cursor, row: row[0]
-        cursor = self.connection.cursor()
-        categories = cursor.execute(query).fetchall()
+        categories = self._execute(query).fetchall()
         self.connection.row_factory = None
         return categories
 
+    def getRawMessage(self, message_id):
+        # The bytes of the message as stored in the file it was imported from,
+        # None when the file is gone.
+        query = 'SELECT path, offset, length FROM MessageSource where message_id = ?'
+
+        for path, offset, length in self._execute(query, (message_id,)):
+            try:
+                with open(path, 'rb') as file:
+                    if length == 0:
+                        return b''
+
+                    # Maps only the pages of the message
+                    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+                    with mmap.mmap(file.fileno(), offset + length - start, offset = start, access = mmap.ACCESS_READ) as data:
+                        return data[offset - start:]
+            except (OSError, ValueError):
+                return None
+
+        return None
+
+    def getImportedFile(self, path):
+        query = 'SELECT file_id, size, mtime, content_hash, parsed_bytes FROM ImportedFile where file_id = ?'
+
+        for row in self._execute(query, (path,)):
+            record = ImportedFile()
+            record.file_id, record.size, record.mtime, record.content_hash, record.parsed_bytes = row
+            return record
+
+        return None
+
     def getAttachementNames(self, message_id):
-        query = 'SELECT attachment_id FROM Attachment '
-        query += ' where message_id = ' + str(message_id)
+        query = 'SELECT attachment_id FROM Attachment where message_id = ?'
 
         self.connection.row_factory = lambda cursor, row: row[0]
-        cursor = self.connection.cursor()
-        attachments = cursor.execute(query).fetchall()
+        attachments = self._execute(query, (message_id,)).fetchall()
         self.connection.row_factory = None
         return attachments
 
+    def getMessageViews(self, message_ids):
+        # Bodies and attachment names of several messages, as returned by
+        # getContent and getAttachementNames
+        views = {}
+        message_ids = list(message_ids)
+
+        # Keep below the limit of query parameters
+        for start in range(0, len(message_ids), 500):
+            batch = message_ids[start:start + 500]
+            marks = ', '.join('?' * len(batch))
+
+            for message_id in batch:
+                views[message_id] = ('', '', [])
+
+            query = 'SELECT message_id, rich_content, content FROM Content where message_id IN (%s)' % marks
+            for row in self._execute(query, batch):
+                views[row[0]] = (unpackBody(row[1]), unpackBody(row[2]), [])
+
+            query = 'SELECT message_id, attachment_id FROM Attachment where message_id IN (%s)' % marks
+            for row in self._execute(query, batch):
+                views[row[0]][2].append(row[1])
+
+        return views
+
     def getAttachmentData(self, message_id, attachment_name):
-        query = 'SELECT data FROM Attachment '
-        query += ' where message_id = "' + str(message_id) + '" and'
-        query += ' attachment_id = "' + attachment_name + '"'
+        query = 'SELECT coalesce(Blob.data, Attachment.data) FROM Attachment \
+                   LEFT JOIN Blob ON Blob.blob_id = Attachment.data_hash \
+                   where Attachment.message_id = ? and Attachment.attachment_id = ?'
 
-        for row in self.connection.execute(query):
+        for row in self._execute(query, (message_id, attachment_name)):
             return row[0]
 
         return None
 
-    def groupConversations(self):
-        self.cleanTable('Messages')
-
-        # Assumption is that all conversations have only two participants,
-        # therefore we expect distinct fields to be set for sender and receiver.
-        # If only the sender is set, then it's the other participant.
-        # If neither is set then there is an old Client and I have no clue how to get that data.
-        # Maybe there is another file with that info... pam pam. Meanwhile, play guess the conversation.
-        query = "insert into Messages \
-                   select thread_id, '', group_concat(participants), 'Conversation from ' || date, date, '', \
-                      group_concat(content,''), 0, '/Conversations', 1 from Conversation group by thread_id order by conversation_id DESC"
-        self.connection.execute(query)
+    def getAttachmentSize(self, message_id, attachment_name):
+        query = 'SELECT coalesce(Blob.size, length(CAST(Attachment.data AS BLOB)), 0) FROM Attachment \
+                   LEFT JOIN Blob ON Blob.blob_id = Attachment.data_hash \
+                   where Attachment.message_id = ? and Attachment.attachment_id = ?'
 
-        # Clean up the receiveres so that we would see uniques
-        query = "SELECT distinct(recipients) FROM Messages"
+        for row in self._execute(query, (message_id, attachment_name)):
+            return row[0]
 
-        for row in self.connection.execute(query):
-            receivers = row[0].split(',')
-            temp = dict.fromkeys(receivers)
-            temp.pop('', None)
-            temp.pop('roscin@gmail.com', None)
-            unique_receivers = list(temp)
-            unique_receivers.sort()
-            self.connection.execute("UPDATE Messages set recipients = '" + ','.join(unique_receivers) +"' where recipients = '" + row[0] + "'")
+        return None
 
-        # Delete the current conversation messages as we will recreate them
-        query = "DELETE FROM Message where is_conversation <> 0"
-        self.connection.execute(query)
+    def copyAttachment(self, message_id, attachment_name, output, chunkSize = 1 << 20, onProgress = None):
+        # Writes the data of the attachment to the output file in chunks, so
+        # large attachments are never held in memory at once. onProgress is
+        # called with the bytes copied and the total after every chunk, and
+        # stops the copy by returning False. Returns the bytes copied, None
+        # when there is no such attachment.
+        query = 'SELECT Blob.rowid, Attachment.rowid FROM Attachment \
+                   LEFT JOIN Blob ON Blob.blob_id = Attachment.data_hash \
+                   where Attachment.message_id = ? and Attachment.attachment_id = ?'
 
-        # Don't group threads by participant, only the conversations
-        query = "insert into Message select * from Messages"
-        self.connection.execute(query)
+        for blobRowId, attachmentRowId in self._execute(query, (message_id, attachment_name)).fetchall():
+            # Attachments stored before the blob store keep their data inline
+            table, rowid = ('Blob', blobRowId) if blobRowId is not None else ('Attachment', attachmentRowId)
+            return self._copyBlob(table, rowid, output, chunkSize, onProgress)
+
+        return None
+
+    def _copyBlob(self, table, rowid, output, chunkSize, onProgress):
+        copied = 0
+
+        if hasattr(self.connection, 'blobopen'):
+            try:
+                blob = self.connection.blobopen(table, 'data', rowid, readonly = True)
+            except sqlite3.OperationalError:
+                # NULL data
+                return 0
+
+            with blob:
+                total = len(blob)
+                for chunk in iter(lambda: blob.read(chunkSize), b''):
+                    output.write(chunk)
+                    copied += len(chunk)
+                    if onProgress is not None and onProgress(copied, total) is False:
+                        break
+
+            return copied
+
+        # Before python 3.11, the data is read in slices
+        query = 'SELECT substr(data, ?, ?) FROM %s where rowid = ?' % table
+        total = self._execute('SELECT length(CAST(data AS BLOB)) FROM %s where rowid = ?' % table, (rowid,)).fetchone()[0] or 0
+
+        while copied < total:
+            chunk = self._execute(query, (copied + 1, chunkSize, rowid)).fetchone()[0]
+            chunk = chunk.encode('utf-8') if isinstance(chunk, str) else bytes(chunk)
+            if not chunk:
+                break
+
+            output.write(chunk)
+            copied += len(chunk)
+            if onProgress is not None and onProgress(copied, total) is False:
+                break
+
+        return copied
+
+    def exportAttachments(self, folder, category = "", recipients = "", sender = "", subject = "", content = "",
+                          chunkSize = 1 << 20, onProgress = None):
+        # Copies the attachments of the messages matching the filters of
+        # getMessages to folder/message_id/name. onProgress is called with the
+        # file being written, the bytes copied and its total, and stops the
+        # export by returning False. Returns the files written, a file the
+        # export stopped in the middle of is removed.
+        messages = [row[0] for row in self.getMessages(category, recipients, sender, subject, content) if row[5]]
+        written  = []
+        state    = {'running' : True}
+
+        def progress(path, copied, total):
+            state['running'] = onProgress(path, copied, total) is not False
+            return state['running']
+
+        for message_id in messages:
+            for name in self.getAttachementNames(message_id):
+                # The names come from the messages, they must not leave the folder
+                path = os.path.join(folder, str(message_id), os.path.basename(name) or 'attachment')
+                os.makedirs(os.path.dirname(path), exist_ok = True)
+
+                with open(path, 'wb') as file:
+                    copied = self.copyAttachment(message_id, name, file, chunkSize,
+                                                 None if onProgress is None else functools.partial(progress, path))
+
+                if not state['running'] and copied != self.getAttachmentSize(message_id, name):
+                    os.remove(path)
+                    try:
+                        os.rmdir(os.path.dirname(path))
+                    except OSError:
+                        # Other attachments of the message are in there
+                        pass
+                    return written
 
-        # Group threads together by participants
-        #query = "insert into Message \
-        #           select message_id, sender, recipients, subject, date, '', group_concat(rich_content, ''), 0, '/Conversations', 1 from Messages \
-        #              where recipients <> 'other' and recipients <> 'me,other' and recipients <> '' group by recipients order by date DESC"
-        #self.connection.execute(query)
-        #query = "insert into Message select * from Messages where recipients = 'other' or recipients = 'me,other' or recipients = ''"
-        #self.connection.execute(query)
+                written.append(path)
 
-        # Single conversation Thread
-        #query = "insert into Message \
-        #           select message_id, sender, recipients, subject, date, '', group_concat(rich_content, ''), 0, '/Conversations', 1 from Messages \
-        #              group by sender order by date ASC"
-        #self.connection.execute(query)
+                if not state['running']:
+                    return written
 
-        self.cleanTable('Messages')
+        return written
+
+    def getSelfAddresses(self):
+        return [address for address in self.getSetting('self_addresses', '').split(',') if address]
+
+    def setSelfAddresses(self, addresses):
+        # The participants of every conversation depend on them
+        self.setSetting('self_addresses', ','.join(addresses))
+        self.groupConversations(True)
+
+    def groupConversations(self, full = False):
+        # Rebuilds the conversation messages of the threads which got new
+        # lines, or of all the threads.
+        with timed('db.groupConversations'), self.connection:
+            if full:
+                self.connection.execute('INSERT OR IGNORE INTO PendingThread (thread_id) SELECT distinct(thread_id) FROM Conversation')
+
+            if self.connection.execute('SELECT count(*) FROM PendingThread').fetchone()[0] == 0:
+                return None
+
+            # Delete the conversation messages as we will recreate them
+            query = "DELETE FROM Content where message_id IN (SELECT thread_id FROM PendingThread)"
+            self._execute(query)
+            query = "DELETE FROM Message where is_conversation <> 0 and message_id IN (SELECT thread_id FROM PendingThread)"
+            self._execute(query)
+
+            # Assumption is that all conversations have only two participants,
+            # therefore we expect distinct fields to be set for sender and receiver.
+            # If only the sender is set, then it's the other participant.
+            # If neither is set then there is an old Client and I have no clue how to get that data.
+            # Maybe there is another file with that info... pam pam. Meanwhile, play guess the conversation.
+            query = "insert into Message (message_id, sender, recipients, subject, date, timestamp, has_attachments, category, is_conversation, is_unread) \
+                       select thread_id, '', uniqueAddresses(group_concat(participants), ?), 'Conversation from ' || min(date), max(date), max(timestamp), \
+                          0, '/Conversations', 1, 0 from Conversation \
+                          where thread_id IN (SELECT thread_id FROM PendingThread) group by thread_id"
+            self._execute(query, (','.join(self.getSelfAddresses()),))
+
+            # The thread gets the addresses of all its lines
+            query = "insert or ignore into MessageAddress (message_id, address_id, role) \
+                       select Conversation.thread_id, MessageAddress.address_id, MessageAddress.role FROM Conversation \
+                         JOIN MessageAddress ON MessageAddress.message_id = Conversation.conversation_id \
+                         where Conversation.thread_id IN (SELECT thread_id FROM PendingThread)"
+            self._execute(query)
+
+            # Lines are concatenated in the order they were written
+            query = "insert into Content (message_id, content, rich_content) \
+                       select thread_id, '', packBody(group_concat(body, '')) from \
+                         (SELECT thread_id, unpackBody(content) AS body FROM Conversation \
+                            where thread_id IN (SELECT thread_id FROM PendingThread) ORDER BY thread_id, timestamp, conversation_id) \
+                       group by thread_id"
+            self._execute(query)
+
+            self.cleanTable('PendingThread')
 
         return None
+
+def explainQueries(db):
+    # Issue the queries of the browse and search paths with their plans printed
+    db.explainQueries = True
+
+    db.getCategories()
+    db.getMessageIds()
+    db.getConversationIds()
+
+    for filters in [{}, {'category' : '/Inbox'}, {'recipients' : 'x'}, {'sender' : 'x'},
+                    {'subject' : 'x'}, {'content' : 'x'}, {'category' : '/Inbox', 'content' : 'x'}]:
+        db.getMessages(**filters)
+        db.getMessagePage(token = (0, 0), **filters)
+        db.getMessagePage(**filters)
+        db.countMessages(limit = 10000, **filters)
+
+    db.getMessages(sender = 'x@example.com')
+    db.getMessages(since = 0, until = 1 << 31)
+    db.getMessagePage(category = '/Inbox', since = 0, until = 1 << 31)
+    db.getCorrespondents(limit = 10)
+    db.getMessages(content = 'x', ranked = True)
+    db.getContent(0)
+    db.getAttachementNames(0)
+    db.getAttachmentData(0, '')
+
+def recompressBodies(db, codec):
+    before, after = db.recompressBodies(codec)
+    print('Database size %d MB -> %d MB (%+.1f%%)' % (before >> 20, after >> 20, 100.0 * (after - before) / max(before, 1)))
+
+commands = {
+    'self-addresses'    : lambda db, addresses: db.setSelfAddresses(addresses.split(',')),
+    'rebuild-index'     : lambda db, full = '': print('Indexed %d messages' % db.rebuildSearchIndex(full = full == 'full')),
+    'rebuild-categories': lambda db: print('Counted %d categories' % db.rebuildCategories()),
+    'rebuild-addresses' : lambda db: print('Linked %d addresses' % db.rebuildAddresses()),
+    'recompress'        : recompressBodies,
+    'explain'           : explainQueries,
+    'dedup'             : lambda db: print('Moved %d attachments, %s' % (
+                                           db.migrateAttachmentBlobs(), db.getAttachmentStatistics()))
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[2] not in commands:
+        print('Usage: ' + sys.argv[0] + ' database.db [' + '|'.join(commands) + '] [arguments]')
+        print('       ' + sys.argv[0] + ' database.db recompress [none|' + '|'.join(bodyCodecs) + ']')
+        print('       ' + sys.argv[0] + ' database.db self-addresses me@example.com,...')
+        print('       ' + sys.argv[0] + ' database.db rebuild-index [full]')
+        exit(-1)
+
+    commands[sys.argv[2]](Database(sys.argv[1]), *sys.argv[3:])
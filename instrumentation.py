@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+
+# Per stage counters and latency histograms of an import, plus the slowest
+# files. Disabled by default, then timing a stage costs a single check.
+
+import collections
+import contextlib
+import cProfile
+import heapq
+import time
+import tracemalloc
+
+enabled = False
+stages  = {}
+# Min-heap of (seconds, path), only keeping the slowest files
+slowestFiles = []
+slowestCount = 10
+
+class Stage():
+    def __init__(self):
+        self.count     = 0
+        self.total     = 0.0
+        self.maximum   = 0.0
+        # Calls per power of two microseconds the call took
+        self.histogram = collections.Counter()
+
+    def add(self, seconds):
+        self.count   += 1
+        self.total   += seconds
+        self.maximum  = max(self.maximum, seconds)
+        self.histogram[int(seconds * 1e6).bit_length()] += 1
+
+    def merge(self, other):
+        self.count   += other.count
+        self.total   += other.total
+        self.maximum  = max(self.maximum, other.maximum)
+        self.histogram.update(other.histogram)
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the percentile, in seconds
+        left = fraction * self.count
+
+        for bucket in sorted(self.histogram):
+            left -= self.histogram[bucket]
+            if left <= 0:
+                return min((1 << bucket) / 1e6, self.maximum)
+
+        return self.maximum
+
+class _Timer():
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        record(self.stage, time.perf_counter() - self.start)
+        return False
+
+class _NullTimer():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+_nullTimer = _NullTimer()
+
+def enable(state = True):
+    global enabled
+    enabled = state
+
+def reset():
+    stages.clear()
+    slowestFiles.clear()
+
+def timed(stage):
+    # with timed('stage'): ... adds the time of the block to the stage
+    return _Timer(stage) if enabled else _nullTimer
+
+def record(stage, seconds):
+    if not enabled:
+        return
+
+    if stage not in stages:
+        stages[stage] = Stage()
+    stages[stage].add(seconds)
+
+def recordFile(path, seconds):
+    if not enabled:
+        return
+
+    if len(slowestFiles) < slowestCount:
+        heapq.heappush(slowestFiles, (seconds, path))
+    else:
+        heapq.heappushpop(slowestFiles, (seconds, path))
+
+def collect():
+    # Takes the measurements of this process, e.g. of a parsing worker, to be
+    # merged into the ones of the importing process.
+    measurements = (dict(stages), list(slowestFiles)) if enabled else None
+    reset()
+    return measurements
+
+def merge(measurements):
+    if measurements is None or not enabled:
+        return
+
+    workerStages, workerFiles = measurements
+
+    for name, stage in workerStages.items():
+        if name not in stages:
+            stages[name] = Stage()
+        stages[name].merge(stage)
+
+    for seconds, path in workerFiles:
+        recordFile(path, seconds)
+
+def report():
+    lines = ['%-24s %9s %10s %10s %10s %10s %10s' % ('stage', 'calls', 'total', 'mean', 'p50', 'p99', 'max')]
+
+    for name, stage in sorted(stages.items(), key = lambda item: -item[1].total):
+        lines.append('%-24s %9d %9.3fs %8.3fms %8.3fms %8.3fms %8.3fms' % (
+            name, stage.count, stage.total, 1e3 * stage.total / max(stage.count, 1),
+            1e3 * stage.percentile(0.5), 1e3 * stage.percentile(0.99), 1e3 * stage.maximum))
+
+    if slowestFiles:
+        lines.append('slowest files:')
+        for seconds, path in sorted(slowestFiles, reverse = True):
+            lines.append('%9.3fs %s' % (seconds, path))
+
+    return '\n'.join(lines)
+
+@contextlib.contextmanager
+def profiled(kind, fileName):
+    # Runs the block under cProfile or tracemalloc and writes the dump to the
+    # file, for pstats or tracemalloc.Snapshot.load. Only this process is
+    # profiled, not the parsing workers.
+    if kind == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(fileName)
+    elif kind == 'tracemalloc':
+        tracemalloc.start(16)
+        try:
+            yield
+        finally:
+            tracemalloc.take_snapshot().dump(fileName)
+            tracemalloc.stop()
+    elif kind is None:
+        yield
+    else:
+        raise ValueError('Unknown profiler: ' + kind)
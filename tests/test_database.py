@@ -0,0 +1,177 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from dataTypes import Attachment
+from dataTypes import Content
+from dataTypes import Message
+from database import Database
+
+def _message(message_id, subject, body):
+    message = Message()
+    message.message_id = message_id
+    message.subject    = subject
+    message.date       = '2023-03-15 12:00:00'
+    message.timestamp  = 1678881600
+    message.category   = '/Inbox'
+
+    content = Content()
+    content.message_id   = message_id
+    content.content      = body
+    content.rich_content = ''
+
+    return [message, content]
+
+class RemapMessageIdsTest(unittest.TestCase):
+    def setUp(self):
+        self.db = Database(':memory:')
+        if not self.db.hasSearch:
+            self.skipTest('sqlite without fts5')
+
+        self.db.insertMany(_message(1, 'first', 'quarterly report') + _message(2, 'second', 'holiday plans'))
+        self.db.connection.commit()
+
+    def test_content_search_after_remap(self):
+        self.db.remapMessageIds([(1, 10), (2, 20)])
+
+        self.assertEqual([row[0] for row in self.db.getMessages(content = 'quarterly')], [10])
+        self.assertEqual([row[0] for row in self.db.getMessages(content = 'holiday')], [20])
+        self.assertEqual(self.db.getContent(10)[1], 'quarterly report')
+
+    def test_remap_onto_existing_message(self):
+        # The message taking an id already in use is a duplicate and dropped
+        self.db.remapMessageIds([(1, 2)])
+
+        self.assertEqual([row[0] for row in self.db.getMessages(content = 'holiday')], [2])
+        self.assertEqual(list(self.db.getMessages(content = 'quarterly')), [])
+
+class SearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.db = Database(':memory:', codec = 'zlib')
+        if not self.db.hasSearch:
+            self.skipTest('sqlite without fts5')
+
+    def assertSearches(self, expected):
+        # expected maps the words, of the bodies unless prefixed with another
+        # column as in 'subject : word', to the ids of the messages with them.
+        # The index is also read on its own, a row left behind by a wrong
+        # delete would still match there.
+        for term, ids in expected.items():
+            column, separator, word = term.rpartition(' : ')
+            column = column or 'content'
+
+            self.assertEqual(sorted(row[0] for row in self.db.getMessages(**{column : word})), ids, term)
+
+            indexed = self.db.connection.execute(
+                'SELECT rowid FROM MessageSearch WHERE MessageSearch MATCH ? ORDER BY rowid', (column + ' : ' + word,)).fetchall()
+            rowids = self.db.connection.execute(
+                'SELECT rowid FROM Message WHERE message_id IN (%s) ORDER BY rowid' % ','.join('?' * len(ids)), ids).fetchall()
+            self.assertEqual(indexed, rowids, term)
+
+    def test_bodies_follow_their_messages(self):
+        # Bodies written before and after their message
+        self.db.insertMany(_message(1, 'first', 'apple banana' * 40)[1:])
+        self.db.insertMany(_message(1, 'first', '')[:1] + _message(2, 'second', 'cherry banana'))
+        self.db.connection.commit()
+        self.assertSearches({'apple': [1], 'banana': [1, 2], 'cherry': [2], 'subject : second': [2]})
+
+        with self.db.connection:
+            self.db.connection.execute("UPDATE Content SET content = packBody('date cherry') WHERE message_id = 1")
+            self.db.connection.execute("UPDATE Message SET subject = 'renamed', is_unread = 1 WHERE message_id = 2")
+        self.assertSearches({'apple': [], 'banana': [2], 'cherry': [1, 2], 'date': [1],
+                             'subject : second': [], 'subject : renamed': [2]})
+
+        with self.db.connection:
+            self.db.connection.execute('DELETE FROM Content WHERE message_id = 2')
+        self.assertSearches({'banana': [], 'cherry': [1]})
+
+        # A body coming in a later transaction than its message
+        self.db.insertMany(_message(3, 'third', '')[:1])
+        self.db.insertMany(_message(3, 'third', 'elder')[1:])
+        with self.db.connection:
+            self.db.connection.execute('DELETE FROM Message WHERE message_id = 3')
+        self.assertSearches({'elder': [], 'subject : third': []})
+
+        self.db.remapMessageIds([(1, 10)])
+        self.db.recompressBodies('none')
+        self.assertSearches({'cherry': [10], 'date': [10]})
+
+        with self.db.connection:
+            self.db.connection.execute('DELETE FROM Message WHERE message_id = 10')
+            self.db.connection.execute('DELETE FROM Content WHERE message_id = 10')
+        self.assertSearches({'cherry': [], 'date': [], 'subject : first': []})
+
+    def test_search_waits_for_the_index(self):
+        self.db.insertMany(_message(1, 'first', 'apple'))
+        self.db.connection.commit()
+
+        # As for a database of an older version, before the index is rebuilt
+        with self.db.connection:
+            self.db.connection.execute("INSERT INTO MessageSearch(MessageSearch) VALUES ('delete-all')")
+        self.db.setSetting('search_index', 'missing')
+
+        self.assertFalse(self.db.checkSearchIndex())
+        self.assertEqual([row[0] for row in self.db.getMessages(content = 'apple')], [1])
+
+        self.assertEqual(self.db.rebuildSearchIndex(), 1)
+        self.assertTrue(self.db.searchReady)
+        self.assertSearches({'apple': [1]})
+
+class AttachmentBlobTest(unittest.TestCase):
+    def attachment(self, message_id, data):
+        attachment = Attachment()
+        attachment.message_id    = message_id
+        attachment.attachment_id = 'report.pdf'
+        attachment.data          = data
+        return attachment
+
+    def blobs(self, db):
+        return db.connection.execute('SELECT blob_id, refcount FROM Blob').fetchall()
+
+    def test_entries_insert_into_another_database(self):
+        entries = _message(1, 'first', 'see attached') + [self.attachment(1, b'%PDF')]
+
+        first, second = Database(':memory:'), Database(':memory:')
+        first.insertMany(entries)
+        second.insertMany(entries)
+
+        self.assertEqual(entries[-1].data, b'%PDF')
+        for db in [first, second]:
+            self.assertEqual([row[1] for row in self.blobs(db)], [1])
+            self.assertEqual(db.getAttachmentStatistics()['savedBytes'], 0)
+
+    def test_ignored_attachment_keeps_no_blob(self):
+        db = Database(':memory:')
+        db.insertMany(_message(1, 'first', 'see attached') + [self.attachment(1, b'%PDF')])
+
+        # Same attachment id, so the row is ignored along with its new data
+        self.assertEqual(db.insert(self.attachment(1, b'%PDF-1.7')), 0)
+        db.connection.commit()
+
+        self.assertEqual([row[1] for row in self.blobs(db)], [1])
+        self.assertEqual(db.getAttachmentStatistics()['savedBytes'], 0)
+
+    def test_stopped_export_leaves_no_partial_file(self):
+        db = Database(':memory:')
+        entries = _message(1, 'first', 'see attached') + [self.attachment(1, b'%PDF' * 100)]
+        entries[0].has_attachments = 1
+        db.insertMany(entries)
+
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+
+        # Stopped after the first of several chunks
+        written = db.exportAttachments(folder.name, chunkSize = 64, onProgress = lambda path, copied, total: False)
+        self.assertEqual(written, [])
+        self.assertEqual(os.listdir(folder.name), [])
+
+        # Stopped after the last one, the file is complete
+        written = db.exportAttachments(folder.name, chunkSize = 400, onProgress = lambda path, copied, total: False)
+        self.assertEqual(written, [os.path.join(folder.name, '1', 'report.pdf')])
+        self.assertEqual(os.path.getsize(written[0]), 400)
+
+if __name__ == '__main__':
+    unittest.main()
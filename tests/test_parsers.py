@@ -0,0 +1,79 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from EmlParser import EmlParser
+from MboxParser import MboxParser
+from MboxParser import read_mbox
+
+message = b'''From: alice@example.com
+To: bob@example.com
+Subject: Plans
+Message-ID: <plans@example.com>
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="outer"
+
+--outer
+Content-Type: multipart/alternative; boundary="inner"
+
+--inner
+Content-Type: text/html
+
+--inner
+Content-Type: text/html
+
+<p>see the plans</p>
+--inner
+Content-Type: text/plain
+
+see the plans
+--inner--
+--outer
+Content-Type: image/png
+Content-Disposition: inline; filename="logo.png"
+
+PNG
+--outer
+Content-Type: application/octet-stream
+Content-Disposition: attachment
+
+DATA
+--outer
+Content-Type: message/rfc822
+
+From: carol@example.com
+Subject: Forwarded
+
+Original
+--outer--
+'''
+
+class ExtractPartsTest(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+
+        self.eml = os.path.join(folder.name, 'plans.eml')
+        with open(self.eml, 'wb') as file:
+            file.write(message)
+
+        self.mbox = os.path.join(folder.name, 'plans.mbox')
+        with open(self.mbox, 'wb') as file:
+            file.write(b'From 1234@xxx Wed Mar 15 12:00:00 +0000 2023\n' + message)
+
+    def test_parsers_agree(self):
+        eml = EmlParser(self.eml)
+        mbox = MboxParser(next(read_mbox(self.mbox))[2])
+
+        for parser in [eml, mbox]:
+            # The empty html part is skipped for the next one
+            self.assertEqual(parser.getPayloadHtml().strip(), '<p>see the plans</p>')
+            self.assertEqual(parser.getPayloadPlain().strip(), 'see the plans')
+            self.assertEqual(parser.getAttachmentNames(), ['logo.png', 'attachment', 'message.eml'])
+            self.assertEqual(parser.getAttachmentData('attachment').strip(), b'DATA')
+
+if __name__ == '__main__':
+    unittest.main()